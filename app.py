@@ -1,82 +1,893 @@
+import time
+SCRIPT_START = time.perf_counter()
+SCRIPT_START_CPU = time.thread_time()
+
 import streamlit as st
-import google.generativeai as genai
 import os
 import re
+import sys
 import json
+import hashlib
+import math
+import mmap
+import heapq
+import bisect
+import codecs
+import random
+import sqlite3
 import datetime
+import threading
+import contextlib
+import html
+import collections
+import uuid
+import csv
+import io
+import itertools
+import textwrap
+import string
+from enum import Enum
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
-load_dotenv()
+IMPORT_SECONDS = time.perf_counter() - SCRIPT_START
 
 DEFAULT_API_KEY = "GOOGLE_API_KEY"
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", DEFAULT_API_KEY)
+DEFAULT_MODEL = 'gemini-2.0-flash'
 
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
-else:
-    st.error("No API key found. Please enter your API key in the sidebar.")
+# Shared key pool: GOOGLE_API_KEYS holds extra comma-separated keys, and keys that hit
+# their quota are rested for a while before they are picked again
+KEY_POOL_STRATEGY = os.getenv("EDUBOT_KEY_POOL_STRATEGY", "least_loaded")
+KEY_COOLDOWN_SECONDS = 60
 
-if 'messages' not in st.session_state:
-    st.session_state['messages'] = [
-        {"role": "assistant", "content": "Hi there! I'm EduBot, your smart study helper. I can generate quizzes, summarize text, solve math problems, create flashcards, and answer your study questions. How can I help you today?"}
-    ]
+DATA_DIR = os.getenv("EDUBOT_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "edubot_data"))
+DB_PATH = os.path.join(DATA_DIR, "edubot.db")
+HISTORY_DIR = os.path.join(DATA_DIR, "history")
+# Only the latest sessions stay in memory; the full history is streamed from disk when it is needed
+HISTORY_RECENT_LIMIT = 50
+
+# Exports read the database a page at a time and imports write cards in batches, so neither holds the database lock for long
+TRANSFER_BATCH_SIZE = 1000
+ANKI_DECK_PREFIX = "EduBot::"
+ANKI_SEPARATORS = {"tab": "\t", "comma": ",", "semicolon": ";", "pipe": "|", "space": " ", "colon": ":"}
+# Header lines of an Anki "Notes in Plain Text" export that mark a column as note metadata rather than a field
+ANKI_METADATA_COLUMNS = ("guid column", "notetype column", "deck column", "tags column")
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS decks (
+    id INTEGER PRIMARY KEY,
+    owner TEXT,
+    topic TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    UNIQUE (owner, topic)
+);
+CREATE TABLE IF NOT EXISTS cards (
+    id INTEGER PRIMARY KEY,
+    deck_id INTEGER NOT NULL REFERENCES decks(id) ON DELETE CASCADE,
+    front TEXT NOT NULL,
+    back TEXT NOT NULL,
+    ease REAL NOT NULL DEFAULT 2.5,
+    interval INTEGER NOT NULL DEFAULT 0,
+    repetitions INTEGER NOT NULL DEFAULT 0,
+    due INTEGER NOT NULL,
+    owner TEXT,
+    UNIQUE (deck_id, front)
+);
+CREATE INDEX IF NOT EXISTS idx_cards_deck_due ON cards (deck_id, due);
+CREATE TABLE IF NOT EXISTS questions (
+    id INTEGER PRIMARY KEY,
+    topic TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    question TEXT NOT NULL,
+    option_a TEXT NOT NULL,
+    option_b TEXT NOT NULL,
+    option_c TEXT NOT NULL,
+    option_d TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    explanation TEXT,
+    created_at INTEGER NOT NULL,
+    UNIQUE (topic, fingerprint)
+);
+CREATE INDEX IF NOT EXISTS idx_questions_topic ON questions (topic);
+CREATE TABLE IF NOT EXISTS documents (
+    hash TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    chunks INTEGER,
+    chars INTEGER NOT NULL DEFAULT 0,
+    created_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS document_chunks (
+    doc_hash TEXT NOT NULL REFERENCES documents(hash) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (doc_hash, idx)
+);
+CREATE TABLE IF NOT EXISTS prompt_cache (
+    key TEXT PRIMARY KEY,
+    template TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS passages (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    doc_hash TEXT REFERENCES documents(hash) ON DELETE CASCADE,
+    idx INTEGER,
+    text TEXT,
+    embedding BLOB,
+    owner TEXT,
+    created_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_passages_doc ON passages (doc_hash);
+CREATE TABLE IF NOT EXISTS study_plans (
+    id INTEGER PRIMARY KEY,
+    topic TEXT NOT NULL,
+    days INTEGER NOT NULL,
+    created_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS study_plan_days (
+    plan_id INTEGER NOT NULL REFERENCES study_plans(id) ON DELETE CASCADE,
+    day INTEGER NOT NULL,
+    focus TEXT NOT NULL,
+    concepts TEXT,
+    activities TEXT,
+    time TEXT,
+    PRIMARY KEY (plan_id, day)
+);
+"""
+
+# Ratings accepted while reviewing due flashcards, mapped to SM-2 quality scores
+REVIEW_GRADES = {'again': 1, 'hard': 3, 'good': 4, 'easy': 5}
+
+# Uploaded documents are read in blocks and split into chunks of roughly this many characters
+DOCUMENT_BLOCK_BYTES = 1 << 20
+DOCUMENT_CHUNK_CHARS = 4000
+DOCUMENT_EXCERPT_CHARS = 12000
+DOCUMENT_WORKERS = 4
+
+# Speculative generation started while the bot waits for a count: the count generated per flow
+# (the maximum, or the most likely answer for study plans) and how long an unused result is kept
+PREFETCH_COUNTS = {'quiz': 5, 'flashcards': 10, 'study_plan': 7}
+PREFETCH_TTL_SECONDS = 120
+
+# Classroom quizzes: one quiz is generated for the teacher and shared with every student who joins
+CLASSROOM_QUESTIONS = 5
+CLASSROOM_TTL_SECONDS = 3 * 3600
+CLASSROOM_LEADERBOARD_SIZE = 10
+CLASSROOM_CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+
+# Phrases that point at the uploaded study material rather than a topic
+DOCUMENT_KEYWORDS = ['document', 'pdf', 'my notes', 'the notes', 'lecture notes', 'uploaded', 'the file', 'my file']
+
+# Retrieval settings: BM25 parameters, passages per answer and their share of the prompt
+BM25_K1 = 1.5
+BM25_B = 0.75
+RETRIEVAL_TOP_K = 4
+RETRIEVAL_TOKEN_BUDGET = 2000
+EMBEDDING_MODEL = 'text-embedding-004'
+USE_EMBEDDINGS = os.getenv("EDUBOT_EMBEDDINGS", "").lower() in ("1", "true", "yes")
+
+# Filler words ignored when fingerprinting quiz questions for deduplication
+QUESTION_STOPWORDS = {
+    'a', 'an', 'the', 'of', 'is', 'are', 'was', 'were', 'which', 'what', 'following',
+    'to', 'in', 'on', 'for', 'and', 'or', 'does', 'do', 'best', 'most', 'these'
+}
+
+class Role(str, Enum):
+    USER = "user"
+    ASSISTANT = "assistant"
+
+class SessionType(str, Enum):
+    QUIZ = "quiz"
+    FLASHCARDS = "flashcards"
+    REVIEW = "review"
+    STUDY_PLAN = "study_plan"
+    POMODORO = "pomodoro"
+    SUMMARY = "summary"
+
+SESSION_TYPE_CODES = {session_type: code for code, session_type in enumerate(SessionType)}
+
+class Intent(str, Enum):
+    REVIEW = "review"
+    STUDY_PLAN_ADJUST = "study_plan_adjust"
+    STUDY_PLAN_EXTEND = "study_plan_extend"
+    FLASHCARDS = "flashcards"
+    FLASHCARDS_PROMPT = "flashcards_prompt"
+    STUDY_PLAN = "study_plan"
+    STUDY_PLAN_PROMPT = "study_plan_prompt"
+    POMODORO = "pomodoro"
+    POMODORO_PROMPT = "pomodoro_prompt"
+    QUIZ = "quiz"
+    QUIZ_PROMPT = "quiz_prompt"
+    DOCUMENT_SUMMARY = "document_summary"
+    SUMMARIZE = "summarize"
+    SUMMARIZE_PROMPT = "summarize_prompt"
+    CLASSROOM_HOST = "classroom_host"
+    CLASSROOM_JOIN = "classroom_join"
+    CLASSROOM_LEAVE = "classroom_leave"
+    MATH = "math"
+    GENERAL = "general"
+
+# Records kept in session state. Slots keep them small, and to_row/from_row give a
+# positional form that is written one JSON array per line.
+
+@dataclass(slots=True)
+class ChatMessage:
+    role: Role
+    content: str
+    
+    def to_row(self):
+        return [self.role.value, self.content]
+    
+    @classmethod
+    def from_row(cls, row):
+        return cls(Role(row[0]), row[1])
+
+@dataclass(slots=True)
+class QuizQuestion:
+    question: str
+    options: tuple
+    answer: str
+    explanation: str = ''
+    
+    def option_items(self):
+        return zip("ABCD", self.options)
+    
+    def to_row(self):
+        return [self.question, *self.options, self.answer, self.explanation]
+    
+    @classmethod
+    def from_row(cls, row):
+        return cls(row[0], tuple(row[1:5]), row[5], row[6])
+
+@dataclass(slots=True)
+class Flashcard:
+    front: str
+    back: str
+    id: int = None
+    ease: float = 2.5
+    interval: int = 0
+    repetitions: int = 0
+    
+    def to_row(self):
+        return [self.front, self.back]
+    
+    @classmethod
+    def from_row(cls, row):
+        return cls(row[0], row[1])
+
+@dataclass(slots=True)
+class ClassroomParticipant:
+    name: str
+    score: int = 0
+    answered: int = 0
+    reached_at: float = 0.0
+    
+    def rank_key(self):
+        # Higher scores first; on a tie, whoever reached the score first
+        return (-self.score, self.reached_at, self.name)
+
+@dataclass(slots=True)
+class StudySession:
+    timestamp: int
+    type: SessionType
+    topic: str
+    duration: int = None
+    correct: int = None
+    total: int = None
+    
+    def to_row(self):
+        return [self.timestamp, self.type.value, self.topic, self.duration, self.correct, self.total]
+    
+    @classmethod
+    def from_row(cls, row):
+        return cls(row[0], SessionType(row[1]), *row[2:])
+
+def dump_jsonl(records):
+    for record in records:
+        yield json.dumps(record.to_row(), ensure_ascii=False, separators=(',', ':')) + '\n'
 
-if 'quiz_active' not in st.session_state:
-    st.session_state['quiz_active'] = False
+def load_jsonl(record_type, lines):
+    for line in lines:
+        if line.strip():
+            yield record_type.from_row(json.loads(line))
 
-if 'debug_mode' not in st.session_state:
-    st.session_state['debug_mode'] = False
+def deep_sizeof(obj, seen=None):
+    # Approximate memory held by obj and everything it references
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
     
-if 'study_history' not in st.session_state:
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__') and not isinstance(obj, Enum):
+        size += sum(deep_sizeof(getattr(obj, slot), seen) for slot in obj.__slots__ if hasattr(obj, slot))
+    elif hasattr(obj, '__dict__') and not isinstance(obj, Enum):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+WELCOME_MESSAGE = "Hi there! I'm EduBot, your smart study helper. I can generate quizzes, summarize text, solve math problems, create flashcards, and answer your study questions. How can I help you today?"
+
+# Per-session state and its initial values; callables build fresh mutable defaults
+SESSION_DEFAULTS = {
+    'user_id': lambda: load_user_id(),
+    'messages': lambda: [ChatMessage(Role.ASSISTANT, WELCOME_MESSAGE)],
+    'quiz_active': False,
+    'debug_mode': False,
+    'study_history': lambda: load_study_history(),
+    'history_analytics': None,
+    'flashcards': list,
+    'flashcard_index': 0,
+    'flashcard_active': False,
+    'current_card_flipped': False,
+    'flashcard_review': False,
+    'pomodoro_active': False,
+    'pomodoro_start_time': None,
+    'pomodoro_duration': 25,
+    'theme': 'light',
+    'perf_metrics': list,
+    'cpu_metrics': dict,
+    'quiz_feedback': None,
+    'prefetch': None,
+    'classroom': None,
+    'prefetch_stats': lambda: {"hits": 0, "misses": 0, "discarded": 0, "seconds_saved": 0.0, "tokens_used": 0, "tokens_wasted": 0},
+}
+
+@st.cache_resource
+def load_settings():
+    # .env only needs to be read once per process, not on every rerun
+    load_dotenv()
+    return os.getenv("GOOGLE_API_KEY", DEFAULT_API_KEY)
+
+@st.cache_resource
+def get_genai():
+    # The SDK is slow to import, so it is only loaded when a model is first needed
+    from google import genai
+    return genai
+
+@st.cache_resource
+def get_history_lock():
+    return threading.Lock()
+
+def load_user_id():
+    # A random id in the page URL keeps each browser's history and materials apart, and survives reloads and bookmarks
+    user_id = st.query_params.get('user', '')
+    if not re.fullmatch(r'[0-9a-f]{32}', user_id):
+        user_id = uuid.uuid4().hex
+        st.query_params['user'] = user_id
+    return user_id
+
+def history_path(user_id):
+    return os.path.join(HISTORY_DIR, f"{user_id}.jsonl")
+
+def iter_study_history(user_id):
+    path = history_path(user_id)
+    if not os.path.exists(path):
+        return
+    with open(path, encoding='utf-8') as f:
+        yield from load_jsonl(StudySession, f)
+
+def load_study_history():
+    return list(collections.deque(iter_study_history(st.session_state['user_id']), maxlen=HISTORY_RECENT_LIMIT))
+
+def clear_study_history():
+    path = history_path(st.session_state['user_id'])
+    with get_history_lock():
+        if os.path.exists(path):
+            os.remove(path)
     st.session_state['study_history'] = []
+    st.session_state['history_analytics'] = None
+
+def init_session_state():
+    schema = tuple(SESSION_DEFAULTS)
+    if st.session_state.get('_session_schema') == schema:
+        return
     
-if 'flashcards' not in st.session_state:
-    st.session_state['flashcards'] = []
+    for key, default in SESSION_DEFAULTS.items():
+        if key not in st.session_state:
+            st.session_state[key] = default() if callable(default) else default
+    st.session_state['_session_schema'] = schema
+
+GOOGLE_API_KEY = load_settings()
+
+if not GOOGLE_API_KEY:
+    st.error("No API key found. Please enter your API key in the sidebar.")
+
+init_session_state()
+
+def save_study_session(session_type, topic, duration=None, correct=None, total=None):
+    session = StudySession(int(time.time()), SessionType(session_type), topic, duration, correct, total)
+    history = st.session_state['study_history']
+    history.append(session)
+    del history[:-HISTORY_RECENT_LIMIT]
     
-if 'flashcard_index' not in st.session_state:
-    st.session_state['flashcard_index'] = 0
+    with get_history_lock():
+        os.makedirs(HISTORY_DIR, exist_ok=True)
+        with open(history_path(st.session_state['user_id']), 'a', encoding='utf-8') as f:
+            f.writelines(dump_jsonl([session]))
+    
+    analytics = st.session_state['history_analytics']
+    if analytics is not None:
+        analytics.append(session)
+
+class HistoryAnalytics:
+    # Study history as growable NumPy columns with running per-topic totals, so the
+    # progress charts are computed without looping over session records in Python
+    COLUMNS = (('timestamp', 'int64'), ('type', 'int8'), ('topic', 'int32'), ('duration', 'int32'), ('correct', 'int32'), ('total', 'int32'))
+    
+    def __init__(self, capacity=1024):
+        import numpy as np
+        self.size = 0
+        self.topics = []
+        self.topic_codes = {}
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self.COLUMNS}
+        self.topic_correct = np.zeros(64, dtype=np.int64)
+        self.topic_total = np.zeros(64, dtype=np.int64)
+        self.focus_minutes = 0
+        self.study_days = set()
+        self.day_offset = time.localtime().tm_gmtoff
+    
+    @classmethod
+    def from_sessions(cls, sessions):
+        # sessions may be a stream straight from the history file; it is read in batches
+        analytics = cls()
+        for batch in iter_batches(sessions, 10000):
+            analytics.extend(batch)
+        return analytics
+    
+    def extend(self, sessions):
+        import numpy as np
+        count = len(sessions)
+        start, end = self.size, self.size + count
+        if end > len(self.columns['timestamp']):
+            for column in self.columns.values():
+                column.resize(max(end, len(column) * 2), refcheck=False)
+        
+        codes = [self.topic_code(session.topic) for session in sessions]
+        columns = {name: column[start:end] for name, column in self.columns.items()}
+        columns['timestamp'][:] = np.fromiter((session.timestamp for session in sessions), np.int64, count)
+        columns['type'][:] = np.fromiter((SESSION_TYPE_CODES[session.type] for session in sessions), np.int8, count)
+        columns['topic'][:] = codes
+        columns['duration'][:] = np.fromiter((session.duration or 0 for session in sessions), np.int32, count)
+        columns['correct'][:] = np.fromiter((session.correct or 0 for session in sessions), np.int32, count)
+        columns['total'][:] = np.fromiter((session.total or 0 for session in sessions), np.int32, count)
+        self.size = end
+        
+        topic_count = len(self.topics)
+        self.topic_correct[:topic_count] += np.bincount(columns['topic'], weights=columns['correct'], minlength=topic_count).astype(np.int64)
+        self.topic_total[:topic_count] += np.bincount(columns['topic'], weights=columns['total'], minlength=topic_count).astype(np.int64)
+        pomodoro = columns['type'] == SESSION_TYPE_CODES[SessionType.POMODORO]
+        self.focus_minutes += int(columns['duration'][pomodoro].sum())
+        self.study_days.update(np.unique((columns['timestamp'] + self.day_offset) // 86400).tolist())
+    
+    def topic_code(self, topic):
+        code = self.topic_codes.get(topic)
+        if code is None:
+            code = self.topic_codes[topic] = len(self.topics)
+            self.topics.append(topic)
+            if code == len(self.topic_total):
+                self.topic_correct.resize(code * 2, refcheck=False)
+                self.topic_total.resize(code * 2, refcheck=False)
+        return code
+    
+    def append(self, session):
+        if self.size == len(self.columns['timestamp']):
+            for column in self.columns.values():
+                column.resize(self.size * 2, refcheck=False)
+        
+        code = self.topic_code(session.topic)
+        row = (session.timestamp, SESSION_TYPE_CODES[session.type], code, session.duration or 0, session.correct or 0, session.total or 0)
+        for (name, _), value in zip(self.COLUMNS, row):
+            self.columns[name][self.size] = value
+        self.size += 1
+        
+        if session.total:
+            self.topic_correct[code] += session.correct
+            self.topic_total[code] += session.total
+        # Compare by value: each rerun executes app.py afresh, so older records hold another copy of SessionType
+        if session.type == SessionType.POMODORO:
+            self.focus_minutes += session.duration or 0
+        self.study_days.add((session.timestamp + self.day_offset) // 86400)
+    
+    def column(self, name):
+        return self.columns[name][:self.size]
+    
+    def type_mask(self, session_type):
+        return self.column('type') == SESSION_TYPE_CODES[session_type]
+    
+    def days(self):
+        # Local calendar days since the epoch
+        return (self.column('timestamp') + self.day_offset) // 86400
+    
+    def today(self):
+        return (int(time.time()) + self.day_offset) // 86400
+    
+    def topic_accuracy(self):
+        import numpy as np
+        count = len(self.topics)
+        correct, total = self.topic_correct[:count], self.topic_total[:count]
+        scored = np.flatnonzero(total)
+        return scored, correct[scored] / total[scored], total[scored]
     
-if 'flashcard_active' not in st.session_state:
-    st.session_state['flashcard_active'] = False
+    def weak_topics(self, limit=5, min_questions=3, below=0.8):
+        import numpy as np
+        codes, accuracy, total = self.topic_accuracy()
+        keep = (total >= min_questions) & (accuracy < below)
+        codes, accuracy, total = codes[keep], accuracy[keep], total[keep]
+        order = np.lexsort((-total, accuracy))[:limit]
+        return [(self.topics[code], float(accuracy[i]), int(total[i])) for i, code in zip(order, codes[order])]
     
-if 'current_card_flipped' not in st.session_state:
+    def streaks(self, today=None):
+        import numpy as np
+        if not self.study_days:
+            return 0, 0
+        today = self.today() if today is None else today
+        
+        current = 0
+        day = today if today in self.study_days else today - 1
+        while day in self.study_days:
+            current += 1
+            day -= 1
+        
+        days = np.array(sorted(self.study_days))
+        breaks = np.flatnonzero(np.diff(days) != 1)
+        run_lengths = np.diff(np.concatenate(([-1], breaks, [len(days) - 1])))
+        return current, int(run_lengths.max())
+    
+    def minutes_per_day(self, days=30):
+        import numpy as np
+        today = self.today()
+        offsets = today - self.days()
+        # Rows stamped later than today (a clock change, or history from another time zone) are left out
+        mask = self.type_mask(SessionType.POMODORO) & (offsets >= 0) & (offsets < days)
+        minutes = np.bincount(days - 1 - offsets[mask], weights=self.column('duration')[mask], minlength=days)
+        epoch = datetime.date(1970, 1, 1).toordinal()
+        return [datetime.date.fromordinal(epoch + day) for day in range(today - days + 1, today + 1)], minutes
+    
+    def accuracy_trend(self, topics=5, weeks=12):
+        # Weekly quiz accuracy for the most-practised topics, one column per topic
+        import numpy as np
+        codes, _, total = self.topic_accuracy()
+        top = codes[np.argsort(-total, kind='stable')[:topics]]
+        if not len(top):
+            return [], {}
+        
+        # The epoch was a Thursday, so shifting by three days makes weeks start on Monday
+        this_week = (self.today() + 3) // 7
+        week = this_week - (self.days() + 3) // 7
+        mask = np.isin(self.column('topic'), top) & (self.column('total') > 0) & (week >= 0) & (week < weeks)
+        slot = np.searchsorted(np.sort(top), self.column('topic')[mask])
+        index = slot * weeks + (weeks - 1 - week[mask])
+        correct = np.bincount(index, weights=self.column('correct')[mask], minlength=len(top) * weeks).reshape(len(top), weeks)
+        total = np.bincount(index, weights=self.column('total')[mask], minlength=len(top) * weeks).reshape(len(top), weeks)
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            accuracy = np.where(total > 0, correct / total * 100, np.nan)
+        epoch = datetime.date(1970, 1, 1).toordinal()
+        week_starts = [datetime.date.fromordinal(epoch + (this_week - weeks + 1 + i) * 7 - 3) for i in range(weeks)]
+        return week_starts, {self.topics[code]: accuracy[i] for i, code in enumerate(np.sort(top))}
+
+def get_history_analytics():
+    if st.session_state['history_analytics'] is None:
+        st.session_state['history_analytics'] = HistoryAnalytics.from_sessions(iter_study_history(st.session_state['user_id']))
+    return st.session_state['history_analytics']
+
+@st.cache_resource
+def get_db():
+    # One connection per process, shared by all sessions and guarded by a lock
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(DB_SCHEMA)
+    migrate_db(conn)
+    # Responses from older template versions can never be hit again
+    keys = [template.key for template in PROMPTS.values()]
+    conn.execute(f"DELETE FROM prompt_cache WHERE template NOT IN ({', '.join('?' * len(keys))})", keys)
+    conn.commit()
+    return conn, threading.RLock()
+
+def migrate_db(conn):
+    # CREATE TABLE IF NOT EXISTS leaves databases from older versions as they were, so later columns are added here
+    deck_columns = {row['name'] for row in conn.execute("PRAGMA table_info(decks)")}
+    if 'owner' not in deck_columns:
+        # SQLite can't drop the old UNIQUE (topic) in place, so the table is rebuilt with foreign keys
+        # off, which keeps the DROP from cascading to the cards. Decks from before owners belong to no one
+        conn.execute("PRAGMA foreign_keys = OFF")
+        conn.executescript("""
+            BEGIN;
+            CREATE TABLE decks_by_owner (
+                id INTEGER PRIMARY KEY,
+                owner TEXT,
+                topic TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                UNIQUE (owner, topic)
+            );
+            INSERT INTO decks_by_owner (id, topic, created_at) SELECT id, topic, created_at FROM decks;
+            DROP TABLE decks;
+            ALTER TABLE decks_by_owner RENAME TO decks;
+            COMMIT;
+        """)
+        conn.execute("PRAGMA foreign_keys = ON")
+    card_columns = {row['name'] for row in conn.execute("PRAGMA table_info(cards)")}
+    if 'owner' not in card_columns:
+        conn.execute("ALTER TABLE cards ADD COLUMN owner TEXT")
+    # Cards carry their deck's owner so a review across all of a user's decks is one index range
+    conn.execute("DROP INDEX IF EXISTS idx_cards_due")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cards_owner_due ON cards (owner, due)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cards_owner ON cards (owner)")
+    passage_columns = {row['name'] for row in conn.execute("PRAGMA table_info(passages)")}
+    if 'owner' not in passage_columns:
+        conn.execute("ALTER TABLE passages ADD COLUMN owner TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_passages_owner ON passages (owner, doc_hash)")
+    cache_columns = {row['name'] for row in conn.execute("PRAGMA table_info(prompt_cache)")}
+    if 'prompt' in cache_columns:
+        conn.execute("ALTER TABLE prompt_cache RENAME COLUMN prompt TO template")
+
+@contextlib.contextmanager
+def db_transaction():
+    conn, lock = get_db()
+    with lock, conn:
+        yield conn
+
+def normalize_topic(topic):
+    return re.sub(r'\s+', ' ', topic or '').strip().lower()
+
+def study_topic_key(topic, document_hash=None):
+    # Material from an upload is banked and saved under its content hash as well as its file name,
+    # so two different files called lecture1.pdf never share questions or a deck
+    return f"{topic} ({document_hash[:12]})" if document_hash else topic
+
+def save_flashcard_deck(owner, topic, cards):
+    now = int(time.time())
+    topic = normalize_topic(topic)
+    with db_transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO decks (owner, topic, created_at) VALUES (?, ?, ?)", (owner, topic, now))
+        deck_id = conn.execute("SELECT id FROM decks WHERE owner = ? AND topic = ?", (owner, topic)).fetchone()[0]
+        conn.executemany(
+            "INSERT OR IGNORE INTO cards (deck_id, owner, front, back, due) VALUES (?, ?, ?, ?, ?)",
+            [(deck_id, owner, card.front, card.back, now) for card in cards]
+        )
+    return deck_id
+
+def get_due_cards(owner, topic=None, limit=20, now=None):
+    # Both queries walk an index on due, so cost grows with the cards returned, not the deck size
+    now = int(time.time()) if now is None else now
+    with db_transaction() as conn:
+        if topic:
+            rows = conn.execute(
+                "SELECT cards.id, front, back, ease, interval, repetitions FROM cards "
+                "JOIN decks ON decks.id = cards.deck_id "
+                "WHERE decks.owner = ? AND decks.topic = ? AND cards.due <= ? ORDER BY cards.due LIMIT ?",
+                (owner, normalize_topic(topic), now, limit)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT id, front, back, ease, interval, repetitions FROM cards "
+                "WHERE owner = ? AND due <= ? ORDER BY due LIMIT ?",
+                (owner, now, limit)
+            ).fetchall()
+    return [Flashcard(row['front'], row['back'], row['id'], row['ease'], row['interval'], row['repetitions']) for row in rows]
+
+def count_due_cards(owner, now=None):
+    now = int(time.time()) if now is None else now
+    with db_transaction() as conn:
+        return conn.execute("SELECT COUNT(*) FROM cards WHERE owner = ? AND due <= ?", (owner, now)).fetchone()[0]
+
+def schedule_review(ease, interval, repetitions, quality, now=None):
+    # SM-2: failed cards start over, passed cards grow their interval by the ease factor
+    now = int(time.time()) if now is None else now
+    if quality < 3:
+        repetitions = 0
+        interval = 1
+    else:
+        repetitions += 1
+        if repetitions == 1:
+            interval = 1
+        elif repetitions == 2:
+            interval = 6
+        else:
+            interval = max(1, round(interval * ease))
+    ease = max(1.3, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    return ease, interval, repetitions, now + interval * 86400
+
+def review_card(owner, card, quality):
+    ease, interval, repetitions, due = schedule_review(card.ease, card.interval, card.repetitions, quality)
+    with db_transaction() as conn:
+        conn.execute(
+            "UPDATE cards SET ease = ?, interval = ?, repetitions = ?, due = ? WHERE id = ? AND owner = ?",
+            (ease, interval, repetitions, due, card.id, owner)
+        )
+    card.ease, card.interval, card.repetitions = ease, interval, repetitions
+
+def normalize_question_text(text):
+    words = re.findall(r'[a-z0-9]+', (text or '').lower())
+    return ' '.join(word for word in words if word not in QUESTION_STOPWORDS)
+
+def question_fingerprint(question):
+    # Case, punctuation, filler words and option order don't make a question new
+    options = sorted(normalize_question_text(option) for option in question.options)
+    key = normalize_question_text(question.question) + '|' + '|'.join(options)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def add_questions_to_bank(topic, questions):
+    now = int(time.time())
+    topic = normalize_topic(topic)
+    rows = [
+        (topic, question_fingerprint(q), q.question, *q.options, q.answer, q.explanation, now)
+        for q in questions
+    ]
+    with db_transaction() as conn:
+        before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO questions (topic, fingerprint, question, option_a, option_b, option_c, option_d, answer, explanation, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        return conn.total_changes - before
+
+def count_bank_questions(topic):
+    with db_transaction() as conn:
+        return conn.execute("SELECT COUNT(*) FROM questions WHERE topic = ?", (normalize_topic(topic),)).fetchone()[0]
+
+def get_bank_questions(topic, limit):
+    with db_transaction() as conn:
+        rows = conn.execute(
+            "SELECT question, option_a, option_b, option_c, option_d, answer, explanation FROM questions "
+            "WHERE topic = ? ORDER BY RANDOM() LIMIT ?",
+            (normalize_topic(topic), limit)
+        ).fetchall()
+    return [
+        QuizQuestion(
+            row['question'],
+            (row['option_a'], row['option_b'], row['option_c'], row['option_d']),
+            row['answer'],
+            row['explanation'] or ''
+        )
+        for row in rows
+    ]
+
+def start_flashcard_review(topic=None):
+    due_cards = get_due_cards(st.session_state['user_id'], topic)
+    if not due_cards:
+        where = f" on {topic}" if topic else ""
+        return f"You don't have any flashcards due for review{where} right now. Create some flashcards or come back later!"
+    
+    st.session_state['flashcards'] = due_cards
+    st.session_state['flashcard_index'] = 0
     st.session_state['current_card_flipped'] = False
+    st.session_state['flashcard_active'] = True
+    st.session_state['flashcard_review'] = True
     
-if 'pomodoro_active' not in st.session_state:
-    st.session_state['pomodoro_active'] = False
+    save_study_session("review", topic or "All decks")
+    card = due_cards[0]
+    return f"Let's review {len(due_cards)} due flashcards!\n\n**Card 1 (Front):** {card.front}\n\nType 'flip' to see the back, then rate yourself with 'again', 'hard', 'good', or 'easy'. Type 'exit' to finish reviewing."
+
+def is_quota_error(error):
+    return getattr(error, 'code', None) == 429 or 'RESOURCE_EXHAUSTED' in str(error)
+
+def mask_api_key(api_key):
+    return f"…{api_key[-4:]}" if len(api_key) > 4 else "…"
+
+class KeyPool:
+    """API keys shared by every session that hasn't entered its own, with per-key load and health."""
     
-if 'pomodoro_start_time' not in st.session_state:
-    st.session_state['pomodoro_start_time'] = None
+    def __init__(self, keys, strategy=KEY_POOL_STRATEGY):
+        self.keys = list(dict.fromkeys(keys))
+        self.clients = {}
+        self.stats = {key: {"in_flight": 0, "requests": 0, "failures": 0, "tokens": 0, "cooldown_until": 0.0} for key in self.keys}
+        self.strategy = strategy
+        self.next_index = 0
+        self.lock = threading.Lock()
     
-if 'pomodoro_duration' not in st.session_state:
-    st.session_state['pomodoro_duration'] = 25
+    def acquire(self, exclude=()):
+        with self.lock:
+            now = time.time()
+            healthy = [key for key in self.keys if key not in exclude and self.stats[key]['cooldown_until'] <= now]
+            if not healthy:
+                return None
+            
+            if self.strategy == 'round_robin':
+                key = healthy[self.next_index % len(healthy)]
+                self.next_index += 1
+            else:
+                key = min(healthy, key=lambda k: (self.stats[k]['in_flight'], self.stats[k]['requests']))
+            
+            self.stats[key]['in_flight'] += 1
+            self.stats[key]['requests'] += 1
+            return key
     
-if 'theme' not in st.session_state:
-    st.session_state['theme'] = 'light'
+    def client(self, key):
+        # Created on first use so that building the pool doesn't import the SDK
+        with self.lock:
+            if key not in self.clients:
+                from google import genai
+                self.clients[key] = genai.Client(api_key=key)
+            return self.clients[key]
+    
+    def release(self, key, tokens=0, error=None):
+        with self.lock:
+            stats = self.stats[key]
+            stats['in_flight'] -= 1
+            stats['tokens'] += tokens
+            if error is not None:
+                stats['failures'] += 1
+                if is_quota_error(error):
+                    stats['cooldown_until'] = time.time() + KEY_COOLDOWN_SECONDS
 
-def save_study_session(session_type, topic, duration=None, score=None):
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    session_data = {
-        "timestamp": timestamp,
-        "type": session_type,
-        "topic": topic,
-        "duration": duration,
-        "score": score
-    }
-    st.session_state['study_history'].append(session_data)
+@st.cache_resource
+def get_key_pool():
+    keys = [key.strip() for key in os.getenv("GOOGLE_API_KEYS", "").split(',') if key.strip()]
+    if os.getenv("GOOGLE_API_KEY"):
+        keys.insert(0, os.getenv("GOOGLE_API_KEY"))
+    return KeyPool(keys)
+
+@st.cache_resource(max_entries=256)
+def get_client(api_key):
+    # One client per key, shared by the sessions using that key
+    return get_genai().Client(api_key=api_key)
+
+class SessionModel:
+    """A Gemini model bound to a session's own API key, or to the shared key pool when it has none."""
+    
+    def __init__(self, model_name, api_key=None):
+        self.model_name = model_name
+        self.api_key = api_key
+        # Resolved here, on the script thread, so worker threads never need Streamlit
+        self.client = get_client(api_key) if api_key else None
+        self.pool = None if api_key else get_key_pool()
+    
+    def _call(self, request):
+        if self.client is not None:
+            return request(self.client)
+        
+        tried = []
+        while True:
+            key = self.pool.acquire(exclude=tried)
+            if key is None:
+                raise RuntimeError("Every API key is cooling down after hitting its quota. Please try again in a minute.")
+            try:
+                response = request(self.pool.client(key))
+            except Exception as e:
+                self.pool.release(key, error=e)
+                if is_quota_error(e):
+                    tried.append(key)
+                    continue
+                raise
+            usage = getattr(response, 'usage_metadata', None)
+            self.pool.release(key, tokens=getattr(usage, 'total_token_count', 0) or 0)
+            return response
+    
+    def generate_content(self, prompt):
+        return self._call(lambda client: client.models.generate_content(model=self.model_name, contents=prompt))
+    
+    def embed_content(self, text, task_type):
+        from google.genai import types
+        config = types.EmbedContentConfig(task_type=task_type)
+        return self._call(lambda client: client.models.embed_content(model=EMBEDDING_MODEL, contents=text, config=config))
+    
+    def list_models(self):
+        return self._call(lambda client: list(client.models.list()))
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def list_model_names(api_key):
+    # Listing models is a network round trip, so the result is reused for an hour
+    return [model.name for model in SessionModel(DEFAULT_MODEL, api_key).list_models()]
 
 def get_model():
-    if 'current_api_key' in st.session_state:
-        genai.configure(api_key=st.session_state['current_api_key'])
-    elif GOOGLE_API_KEY:
-        genai.configure(api_key=GOOGLE_API_KEY)
-        st.session_state['current_api_key'] = GOOGLE_API_KEY
+    api_key = st.session_state.get('current_api_key')
+    if not api_key and not get_key_pool().keys:
+        st.error("No API key found. Please enter your API key in the sidebar.")
+        return None
     
     try:
-        DEFAULT_MODEL = 'gemini-2.0-flash'
-        
         try:
-            available_models = [model.name for model in genai.list_models()]
+            available_models = list_model_names(api_key)
             st.session_state['available_models'] = available_models
             
             model_to_use = None
@@ -110,7 +921,7 @@ def get_model():
             if model_to_use:
                 if st.session_state['debug_mode']:
                     st.sidebar.success(f"Using model: {model_to_use}")
-                return genai.GenerativeModel(model_to_use)
+                return SessionModel(model_to_use, api_key)
             else:
                 st.error("No compatible models found")
                 return None
@@ -118,7 +929,7 @@ def get_model():
         except Exception as e:
             if st.session_state['debug_mode']:
                 st.sidebar.warning(f"Error listing models: {str(e)}")
-            return genai.GenerativeModel(DEFAULT_MODEL)
+            return SessionModel(DEFAULT_MODEL, api_key)
             
     except Exception as e:
         st.error(f"Error setting up the model: {str(e)}")
@@ -128,13 +939,42 @@ def get_model():
             st.info(f"Available models: {', '.join(st.session_state['available_models'])}")
         return None
 
-def generate_quiz(topic, num_questions=3):
-    model = get_model()
-    if not model:
-        return "Error: Could not initialize the AI model. Please check your API key."
-        
-    prompt = f"""
-    Create a quiz about {topic} with {num_questions} multiple-choice questions.
+def estimate_tokens(text):
+    # Rough count that holds well enough for English prose (about four characters per token)
+    return len(text) // 4 + 1
+
+@dataclass(frozen=True, slots=True)
+class PromptTemplate:
+    name: str
+    version: int
+    text: str
+    fields: tuple
+    tokens: int
+    
+    @property
+    def key(self):
+        return f"{self.name}@v{self.version}"
+    
+    def measure(self, **fields):
+        # Template tokens plus every filled-in field, counted once per placeholder
+        return self.tokens + sum(estimate_tokens(str(fields[field])) for field in self.fields if field in fields)
+    
+    def render(self, **fields):
+        return self.text.format(**fields)
+
+# Bump a template's version whenever its text changes, so cached responses from the old wording are dropped
+PROMPT_TOKEN_BUDGET = int(os.getenv("EDUBOT_PROMPT_TOKEN_BUDGET", "8000"))
+PROMPTS = {}
+
+def register_prompt(name, version, text):
+    # Templates are written indented for readability; the model only sees the dedented text
+    text = textwrap.dedent(text).strip()
+    fields = tuple(field for _, field, _, _ in string.Formatter().parse(text) if field)
+    static_text = ''.join(literal for literal, _, _, _ in string.Formatter().parse(text))
+    PROMPTS[name] = PromptTemplate(name, version, text, fields, estimate_tokens(static_text))
+
+register_prompt("quiz", 2, """
+    Create a quiz about {topic} with {count} multiple-choice questions.
     For each question:
     1. Provide a clear question related to {topic}
     2. Give 4 possible answers labeled A, B, C, and D
@@ -150,7 +990,167 @@ def generate_quiz(topic, num_questions=3):
     Explanation: [Brief explanation of why this is correct]
     
     Separate each question with a blank line.
-    """
+""")
+
+register_prompt("flashcards", 2, """
+    Create {count} flashcards about {topic}.
+    For each flashcard:
+    1. Provide a clear term, concept, or question on the front
+    2. Provide a concise definition, explanation, or answer on the back
+    
+    Format the output as follows for each flashcard:
+    Front: [Term/Concept/Question]
+    Back: [Definition/Explanation/Answer]
+    
+    Separate each flashcard with a blank line.
+""")
+
+register_prompt("source_material", 1, """
+    Base every {item} only on the following study material:
+    {text}
+""")
+
+register_prompt("study_plan", 2, """
+    {scope}
+    For each day, include:
+    1. Main focus/objective for the day
+    2. Key concepts to study
+    3. Suggested activities or exercises
+    4. Estimated time needed
+    
+    Format the output as follows for each day:
+    Day {start_day}:
+    Focus: [Main objective]
+    Concepts: [Key concepts]
+    Activities: [Suggested activities]
+    Time: [Estimated time in hours]
+    
+    Separate each day with a blank line.
+""")
+
+register_prompt("study_plan_scope", 1, """
+    Create a {total_days}-day study plan for learning about {topic}.
+""")
+
+register_prompt("study_plan_segment_scope", 1, """
+    Create days {start_day} to {end_day} of a {total_days}-day study plan for learning about {topic}. Only write these days, and pace them for where they fall in the overall plan.
+""")
+
+register_prompt("study_plan_context", 1, """
+    The surrounding days of the plan are:
+    {context}
+""")
+
+register_prompt("study_plan_instructions", 1, """
+    The student asked for the following change: {instructions}
+""")
+
+register_prompt("summary", 2, """
+    Please summarize the following text into 1-2 concise sentences that capture the key points.
+    Make the summary simple, clear, and easy to understand.
+    
+    TEXT TO SUMMARIZE:
+    {text}
+""")
+
+register_prompt("document_chunk_summary", 2, """
+    Summarize the following section of a student's study material in 3-5 sentences.
+    Keep the key facts, definitions, and ideas.
+    
+    SECTION:
+    {text}
+""")
+
+register_prompt("document_overview", 2, """
+    Combine these section summaries of "{name}" into one clear overview.
+    Start with a short paragraph, then list the most important points as bullets.
+    
+    SECTION SUMMARIES:
+    {summaries}
+""")
+
+register_prompt("math", 2, """
+    Please solve this math problem step by step:
+    {problem}
+    
+    Provide a clear, detailed solution showing each step of your work.
+    If this involves calculus, algebra, or other mathematical concepts, explain the key principles involved.
+    Make your explanation understandable to a student learning this topic.
+""")
+
+register_prompt("general_answer", 2, """
+    You are EduBot, a friendly and helpful educational assistant. Answer the following question
+    in a conversational, helpful manner. If the question is outside the educational domain,
+    politely steer the conversation back to education.
+    
+    Question: {question}
+""")
+
+register_prompt("grounding", 1, """
+    Ground your answer in these excerpts from the student's own study materials when they are relevant:
+    {excerpts}
+""")
+
+def render_prompt(*parts):
+    # parts are (template name, fields) pairs; None marks an optional part that was left out
+    return '\n\n'.join(PROMPTS[part[0]].render(**part[1]) for part in parts if part)
+
+def truncate_to_tokens(text, max_tokens):
+    max_chars = max(0, max_tokens - 1) * 4
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(' ', max_chars // 2, max_chars)
+    return text[:cut if cut != -1 else max_chars].rstrip() + " [...]"
+
+def split_to_tokens(text, max_tokens):
+    return list(chunk_text_stream([text], chunk_size=max(1, max_tokens - 1) * 4))
+
+def input_budget(*parts, budget=None):
+    # Tokens left for the one open-ended input once the given templates and their other fields are counted
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    return budget - sum(PROMPTS[part[0]].measure(**part[1]) for part in parts if part)
+
+def prompt_cache_key(name, prompt):
+    # Keyed by template version as well as the prompt, so editing a template only misses its own entries
+    return f"{PROMPTS[name].key}:{hashlib.sha1(prompt.encode('utf-8')).hexdigest()}"
+
+def load_cached_response(key):
+    with db_transaction() as conn:
+        row = conn.execute("SELECT response FROM prompt_cache WHERE key = ?", (key,)).fetchone()
+    return row['response'] if row else None
+
+def store_cached_response(name, key, text):
+    with db_transaction() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO prompt_cache (key, template, response, created_at) VALUES (?, ?, ?, ?)",
+            (key, PROMPTS[name].key, text, int(time.time()))
+        )
+
+def generate_text(model, prompt):
+    return extract_response_text(model.generate_content(prompt)).strip()
+
+def generate_cached(model, name, prompt):
+    key = prompt_cache_key(name, prompt)
+    text = load_cached_response(key)
+    if text is None:
+        text = generate_text(model, prompt)
+        store_cached_response(name, key, text)
+    return text
+
+def quiz_prompt(topic, num_questions, source_text=None):
+    quiz = ("quiz", {"topic": topic, "count": num_questions})
+    source = None
+    if source_text:
+        limit = input_budget(quiz, ("source_material", {"item": "question"}))
+        source = ("source_material", {"item": "question", "text": truncate_to_tokens(source_text, limit)})
+    return render_prompt(quiz, source)
+
+def generate_quiz(topic, num_questions=3, source_text=None):
+    model = get_model()
+    if not model:
+        return "Error: Could not initialize the AI model. Please check your API key."
+        
+    prompt = quiz_prompt(topic, num_questions, source_text)
     
     try:
         response = model.generate_content(prompt)
@@ -164,23 +1164,20 @@ def generate_quiz(topic, num_questions=3):
         st.error(f"API Error: {str(e)}")
         return f"Failed to generate quiz: {str(e)}"
 
-def generate_flashcards(topic, num_cards=5):
+def flashcards_prompt(topic, num_cards, source_text=None):
+    flashcards = ("flashcards", {"topic": topic, "count": num_cards})
+    source = None
+    if source_text:
+        limit = input_budget(flashcards, ("source_material", {"item": "flashcard"}))
+        source = ("source_material", {"item": "flashcard", "text": truncate_to_tokens(source_text, limit)})
+    return render_prompt(flashcards, source)
+
+def generate_flashcards(topic, num_cards=5, source_text=None):
     model = get_model()
     if not model:
         return "Error: Could not initialize the AI model. Please check your API key."
         
-    prompt = f"""
-    Create {num_cards} flashcards about {topic}.
-    For each flashcard:
-    1. Provide a clear term, concept, or question on the front
-    2. Provide a concise definition, explanation, or answer on the back
-    
-    Format the output as follows for each flashcard:
-    Front: [Term/Concept/Question]
-    Back: [Definition/Explanation/Answer]
-    
-    Separate each flashcard with a blank line.
-    """
+    prompt = flashcards_prompt(topic, num_cards, source_text)
     
     try:
         response = model.generate_content(prompt)
@@ -217,7 +1214,7 @@ def parse_flashcards(flashcards_text):
                     card_dict["back"] = line.split(':', 1)[1].strip()
             
             if "front" in card_dict and "back" in card_dict:
-                cards.append(card_dict)
+                cards.append(Flashcard(card_dict["front"], card_dict["back"]))
         
         return cards
     except Exception as e:
@@ -260,7 +1257,12 @@ def parse_quiz(quiz_text):
             
             if "question" in q_dict and len(q_dict["options"]) == 4 and "answer" in q_dict:
                 if q_dict["answer"].strip() in ["A", "B", "C", "D"]:
-                    questions.append(q_dict)
+                    questions.append(QuizQuestion(
+                        q_dict["question"],
+                        tuple(q_dict["options"][letter] for letter in "ABCD"),
+                        q_dict["answer"].strip(),
+                        q_dict.get("explanation", "")
+                    ))
         
         return questions
     except Exception as e:
@@ -268,18 +1270,566 @@ def parse_quiz(quiz_text):
             st.error(f"Error parsing quiz: {str(e)}")
         return []
 
-def summarize_text(text):
+def assemble_quiz(topic, num_questions, document_hash=None):
+    # Serve what the question bank already has and only ask the model for the shortfall
+    key = study_topic_key(topic, document_hash)
+    questions = get_bank_questions(key, num_questions)
+    shortfall = num_questions - len(questions)
+    
+    if shortfall > 0:
+        source_text = document_excerpt(document_hash) if document_hash else None
+        generated = parse_quiz(generate_quiz(topic, shortfall, source_text))
+        add_questions_to_bank(key, generated)
+        
+        seen = {question_fingerprint(q) for q in questions}
+        for q in generated:
+            fingerprint = question_fingerprint(q)
+            if fingerprint not in seen:
+                seen.add(fingerprint)
+                questions.append(q)
+    
+    return questions[:num_questions]
+
+def format_quiz_question(question, number):
+    options_text = "\n".join([f"{k}: {v}" for k, v in question.option_items()])
+    return f"**Question {number}:** {question.question}\n\n{options_text}\n\nReply with just the letter of your answer (A, B, C, or D)."
+
+def summarize_text(text):
+    model = get_model()
+    if not model:
+        return "Error: Could not initialize the AI model. Please check your API key."
+        
+    try:
+        # Text too long for one prompt is summarized in sections, then the section summaries are summarized
+        limit = input_budget(("summary", {}))
+        sections = split_to_tokens(text, limit) if estimate_tokens(text) > limit else [text]
+        while len(sections) > 1:
+            summaries = [generate_cached(model, "summary", render_prompt(("summary", {"text": section}))) for section in sections]
+            combined = split_to_tokens('\n\n'.join(summaries), limit)
+            sections = combined if len(combined) < len(sections) else [truncate_to_tokens('\n\n'.join(summaries), limit)]
+        return generate_cached(model, "summary", render_prompt(("summary", {"text": sections[0]})))
+    except Exception as e:
+        st.error(f"API Error: {str(e)}")
+        return f"Failed to summarize text: {str(e)}"
+
+def extract_response_text(response):
+    if hasattr(response, 'text'):
+        return response.text
+    elif hasattr(response, 'parts'):
+        return ''.join([part.text for part in response.parts])
+    else:
+        return str(response)
+
+def study_plan_prompt(topic, total_days, start_day, end_day, instructions=None, context=None):
+    scope_name = "study_plan_scope" if start_day == 1 and end_day == total_days else "study_plan_segment_scope"
+    scope = PROMPTS[scope_name].render(topic=topic, total_days=total_days, start_day=start_day, end_day=end_day)
+    plan = ("study_plan", {"scope": scope, "start_day": start_day})
+    context_part = ("study_plan_context", {"context": context}) if context else None
+    
+    instructions_part = None
+    if instructions:
+        limit = input_budget(plan, context_part, ("study_plan_instructions", {}))
+        instructions_part = ("study_plan_instructions", {"instructions": truncate_to_tokens(instructions, limit)})
+    return render_prompt(plan, context_part, instructions_part)
+
+def parse_study_plan(plan_text):
+    try:
+        plan_days = []
+        current_day = None
+        
+        for line in plan_text.split('\n'):
+            # Models often decorate the format with bullets or bold markers
+            line = line.strip().lstrip('-*• ').strip()
+            if not line:
+                continue
+            
+            day_match = re.match(r'Day\s+(\d+)\b', line, re.IGNORECASE)
+            if day_match:
+                current_day = {"day": int(day_match.group(1)), "focus": "", "concepts": "", "activities": "", "time": ""}
+                plan_days.append(current_day)
+            elif current_day is not None and ':' in line:
+                field, value = line.split(':', 1)
+                field = field.strip('* ').lower()
+                if field in ("focus", "concepts", "activities", "time"):
+                    current_day[field] = value.strip('* ')
+        
+        return [day for day in plan_days if day["focus"]]
+    except Exception as e:
+        if 'debug_mode' in st.session_state and st.session_state['debug_mode']:
+            st.error(f"Error parsing study plan: {str(e)}")
+        return []
+
+def format_study_plan(plan_days):
+    sections = []
+    for day in plan_days:
+        sections.append(
+            f"**Day {day['day']}:**\n"
+            f"- **Focus:** {day['focus']}\n"
+            f"- **Concepts:** {day['concepts']}\n"
+            f"- **Activities:** {day['activities']}\n"
+            f"- **Time:** {day['time']}"
+        )
+    return "\n\n".join(sections)
+
+def missing_plan_days(plan_days, start_day, end_day):
+    covered = {day["day"] for day in plan_days}
+    return [number for number in range(start_day, end_day + 1) if number not in covered]
+
+def generate_study_plan_days(model, topic, total_days, start_day, end_day, instructions=None, context=None):
+    # Long ranges are split into week-sized segments that are generated in parallel. A segment that comes back
+    # with days missing is generated once more; callers check for days that are still missing after that
+    segments = [(first, min(first + 6, end_day)) for first in range(start_day, end_day + 1, 7)]
+    plan_days = {}
+    for _ in range(2):
+        prompts = [study_plan_prompt(topic, total_days, first, last, instructions, context) for first, last in segments]
+        # The workers only call the model; parsing reads st.session_state, so it stays on the script thread
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            texts = list(executor.map(lambda prompt: extract_response_text(model.generate_content(prompt)), prompts))
+        
+        for (first, last), text in zip(segments, texts):
+            for day in parse_study_plan(text):
+                if first <= day["day"] <= last:
+                    plan_days[day["day"]] = day
+        
+        segments = [(first, last) for first, last in segments if missing_plan_days(plan_days.values(), first, last)]
+        if not segments:
+            break
+    return [plan_days[number] for number in sorted(plan_days)]
+
+def save_study_plan_days(plan_id, plan_days):
+    with db_transaction() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO study_plan_days (plan_id, day, focus, concepts, activities, time) VALUES (?, ?, ?, ?, ?, ?)",
+            [(plan_id, day["day"], day["focus"], day["concepts"], day["activities"], day["time"]) for day in plan_days]
+        )
+        conn.execute(
+            "UPDATE study_plans SET days = MAX(days, (SELECT MAX(day) FROM study_plan_days WHERE plan_id = ?)) WHERE id = ?",
+            (plan_id, plan_id)
+        )
+
+def get_study_plan(plan_id):
+    with db_transaction() as conn:
+        plan = conn.execute("SELECT id, topic, days FROM study_plans WHERE id = ?", (plan_id,)).fetchone()
+        if plan is None:
+            return None, []
+        rows = conn.execute(
+            "SELECT day, focus, concepts, activities, time FROM study_plan_days WHERE plan_id = ? ORDER BY day",
+            (plan_id,)
+        ).fetchall()
+    return dict(plan), [dict(row) for row in rows]
+
+def create_study_plan(topic, days=7, plan_days=None):
+    # A prefetched plan with days missing is generated again rather than saved with holes
+    if not plan_days or missing_plan_days(plan_days, 1, days):
+        model = get_model()
+        if not model:
+            return "Error: Could not initialize the AI model. Please check your API key."
+        
+        try:
+            plan_days = generate_study_plan_days(model, topic, days, 1, days)
+        except Exception as e:
+            st.error(f"API Error: {str(e)}")
+            return f"Failed to create study plan: {str(e)}"
+    
+    if not plan_days:
+        return "Failed to create study plan: the response did not contain any days in the expected format."
+    missing = missing_plan_days(plan_days, 1, days)
+    if missing:
+        return f"Failed to create study plan: {'day' if len(missing) == 1 else 'days'} {', '.join(map(str, missing))} could not be generated. Please try again."
+    
+    with db_transaction() as conn:
+        plan_id = conn.execute(
+            "INSERT INTO study_plans (topic, days, created_at) VALUES (?, ?, ?)",
+            (topic.strip(), days, int(time.time()))
+        ).lastrowid
+    save_study_plan_days(plan_id, plan_days)
+    st.session_state['current_study_plan_id'] = plan_id
+    
+    plan_text = format_study_plan(plan_days)
+    index_output(plan_text, f"Study plan for {topic}")
+    return plan_text
+
+def plan_context(plan_days, start_day, end_day):
+    neighbours = [day for day in plan_days if day["day"] in (start_day - 1, end_day + 1)]
+    return "\n".join(f"Day {day['day']}: {day['focus']}" for day in neighbours)
+
+def regenerate_study_plan_days(plan_id, start_day, end_day, instructions=None):
+    plan, plan_days = get_study_plan(plan_id)
+    if plan is None:
+        return "I couldn't find your study plan. Ask me to create a new one!"
+    if not 1 <= start_day <= end_day <= plan['days']:
+        return f"Your study plan covers days 1 to {plan['days']}. Please pick days in that range."
+    
+    model = get_model()
+    if not model:
+        return "Error: Could not initialize the AI model. Please check your API key."
+    
+    try:
+        new_days = generate_study_plan_days(
+            model, plan['topic'], plan['days'], start_day, end_day,
+            instructions, plan_context(plan_days, start_day, end_day)
+        )
+    except Exception as e:
+        st.error(f"API Error: {str(e)}")
+        return f"Failed to update study plan: {str(e)}"
+    
+    if not new_days:
+        return "I couldn't rewrite those days just now. Could you try again?"
+    
+    save_study_plan_days(plan_id, new_days)
+    label = f"Day {start_day}" if start_day == end_day else f"Days {start_day}-{end_day}"
+    return f"Here's the updated {label} of your study plan for {plan['topic']}:\n\n{format_study_plan(new_days)}\n\nThe rest of your plan is unchanged."
+
+def extend_study_plan(plan_id, extra_days):
+    plan, plan_days = get_study_plan(plan_id)
+    if plan is None:
+        return "I couldn't find your study plan. Ask me to create a new one!"
+    
+    model = get_model()
+    if not model:
+        return "Error: Could not initialize the AI model. Please check your API key."
+    
+    start_day = plan['days'] + 1
+    end_day = plan['days'] + extra_days
+    try:
+        new_days = generate_study_plan_days(
+            model, plan['topic'], end_day, start_day, end_day,
+            context=plan_context(plan_days, start_day, end_day)
+        )
+    except Exception as e:
+        st.error(f"API Error: {str(e)}")
+        return f"Failed to extend study plan: {str(e)}"
+    
+    if not new_days or missing_plan_days(new_days, start_day, end_day):
+        return "I couldn't extend your plan just now. Could you try again?"
+    
+    save_study_plan_days(plan_id, new_days)
+    return f"I've added {len(new_days)} more days to your study plan for {plan['topic']}:\n\n{format_study_plan(new_days)}"
+
+def iter_document_blocks(source):
+    # Paths are memory-mapped; uploaded files are read through a view of their existing buffer
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for offset in range(0, len(view), DOCUMENT_BLOCK_BYTES):
+                    with view[offset:offset + DOCUMENT_BLOCK_BYTES] as block:
+                        yield block
+    else:
+        with source.getbuffer() as view:
+            for offset in range(0, len(view), DOCUMENT_BLOCK_BYTES):
+                with view[offset:offset + DOCUMENT_BLOCK_BYTES] as block:
+                    yield block
+
+def hash_document(source):
+    digest = hashlib.sha256()
+    for block in iter_document_blocks(source):
+        digest.update(block)
+    return digest.hexdigest()
+
+def extract_document_text(source, name):
+    # Yields the text piece by piece: one page at a time for PDFs, one block at a time otherwise
+    if name.lower().endswith('.pdf'):
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            raise RuntimeError("Reading PDFs requires the 'pypdf' package. Install it with: pip install pypdf")
+        
+        reader = PdfReader(source)
+        for page in reader.pages:
+            page_text = page.extract_text() or ''
+            if page_text.strip():
+                yield page_text + '\n\n'
+    else:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        for block in iter_document_blocks(source):
+            yield decoder.decode(block)
+        yield decoder.decode(b'', final=True)
+
+def chunk_text_stream(pieces, chunk_size=DOCUMENT_CHUNK_CHARS):
+    buffer = ''
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= chunk_size:
+            # Prefer to cut at a paragraph break, then at a space
+            cut = buffer.rfind('\n\n', chunk_size // 2, chunk_size)
+            if cut == -1:
+                cut = buffer.rfind(' ', chunk_size // 2, chunk_size)
+            if cut == -1:
+                cut = chunk_size
+            chunk = buffer[:cut].strip()
+            buffer = buffer[cut:]
+            if chunk:
+                yield chunk
+    
+    if buffer.strip():
+        yield buffer.strip()
+
+def get_document(doc_hash):
+    with db_transaction() as conn:
+        row = conn.execute("SELECT hash, name, chunks, chars FROM documents WHERE hash = ?", (doc_hash,)).fetchone()
+    return dict(row) if row else None
+
+def get_document_chunk(doc_hash, idx):
+    with db_transaction() as conn:
+        row = conn.execute("SELECT text FROM document_chunks WHERE doc_hash = ? AND idx = ?", (doc_hash, idx)).fetchone()
+    return row['text'] if row else ''
+
+def ingest_document(source, name):
+    # Chunks are written as they are produced, so the full text is never held in memory
+    doc_hash = hash_document(source)
+    document = get_document(doc_hash)
+    if document and document['chunks'] is not None:
+        return document
+    
+    with db_transaction() as conn:
+        conn.execute("DELETE FROM documents WHERE hash = ?", (doc_hash,))
+        conn.execute("INSERT INTO documents (hash, name, created_at) VALUES (?, ?, ?)", (doc_hash, name, int(time.time())))
+    
+    chunk_count = 0
+    char_count = 0
+    batch = []
+    for chunk in chunk_text_stream(extract_document_text(source, name)):
+        batch.append((doc_hash, chunk_count, chunk))
+        chunk_count += 1
+        char_count += len(chunk)
+        if len(batch) >= 50:
+            with db_transaction() as conn:
+                conn.executemany("INSERT INTO document_chunks (doc_hash, idx, text) VALUES (?, ?, ?)", batch)
+            batch = []
+    
+    with db_transaction() as conn:
+        conn.executemany("INSERT INTO document_chunks (doc_hash, idx, text) VALUES (?, ?, ?)", batch)
+        conn.execute("UPDATE documents SET chunks = ?, chars = ? WHERE hash = ?", (chunk_count, char_count, doc_hash))
+    
+    return get_document(doc_hash)
+
+def document_excerpt(doc_hash, max_chars=DOCUMENT_EXCERPT_CHARS):
+    # Spread the excerpt across the whole document, starting at a random offset so repeat requests cover new ground
+    document = get_document(doc_hash)
+    if not document or not document['chunks']:
+        return ''
+    
+    count = min(document['chunks'], max(1, max_chars // DOCUMENT_CHUNK_CHARS))
+    step = document['chunks'] / count
+    offset = random.uniform(0, step)
+    indexes = sorted({min(document['chunks'] - 1, int(offset + i * step)) for i in range(count)})
+    
+    return '\n\n'.join(get_document_chunk(doc_hash, idx) for idx in indexes)
+
+def summarize_document_chunks(model, executor, doc_hash, indexes):
+    # Chunks and the prompt cache are read and written here on the script thread; the workers only call the model
+    prompts = [render_prompt(("document_chunk_summary", {"text": get_document_chunk(doc_hash, idx)})) for idx in indexes]
+    keys = [prompt_cache_key("document_chunk_summary", prompt) for prompt in prompts]
+    summaries = [load_cached_response(key) for key in keys]
+    missing = [i for i, summary in enumerate(summaries) if summary is None]
+    for i, text in zip(missing, executor.map(lambda i: generate_text(model, prompts[i]), missing)):
+        store_cached_response("document_chunk_summary", keys[i], text)
+        summaries[i] = text
+    return summaries
+
+def combine_document_summaries(model, name, summaries_text):
+    prompt = render_prompt(("document_overview", {"name": name, "summaries": summaries_text}))
+    return generate_cached(model, "document_overview", prompt)
+
+def summarize_document(doc_hash):
+    document = get_document(doc_hash)
+    if not document or not document['chunks']:
+        return "I couldn't find any text in that document."
+    
+    model = get_model()
+    if not model:
+        return "Error: Could not initialize the AI model. Please check your API key."
+    
+    try:
+        # Map: summarize each section, a few at a time
+        summaries = []
+        with ThreadPoolExecutor(max_workers=DOCUMENT_WORKERS) as executor:
+            for first in range(0, document['chunks'], DOCUMENT_WORKERS):
+                indexes = range(first, min(first + DOCUMENT_WORKERS, document['chunks']))
+                summaries.extend(summarize_document_chunks(model, executor, doc_hash, indexes))
+        
+        # Reduce: merge section summaries until one overview remains
+        while len(summaries) > 1:
+            groups = list(chunk_text_stream(summary + '\n\n' for summary in summaries))
+            if len(groups) == len(summaries):
+                groups = ['\n\n'.join(summaries)]
+            summaries = [combine_document_summaries(model, document['name'], group) for group in groups]
+        
+        return summaries[0]
+    except Exception as e:
+        st.error(f"API Error: {str(e)}")
+        return f"Failed to summarize document: {str(e)}"
+
+def tokenize(text):
+    return [word for word in re.findall(r'[a-z0-9]+', text.lower()) if word not in QUESTION_STOPWORDS]
+
+class RetrievalIndex:
+    """In-memory BM25 inverted index over passages stored in the passages table."""
+    
+    def __init__(self):
+        self.postings = {}
+        self.lengths = {}
+        self.total_length = 0
+        self.vectors = {}
+        self.lock = threading.Lock()
+    
+    def add(self, passage_id, text, vector=None):
+        terms = {}
+        for term in tokenize(text):
+            terms[term] = terms.get(term, 0) + 1
+        
+        with self.lock:
+            for term, frequency in terms.items():
+                self.postings.setdefault(term, {})[passage_id] = frequency
+            self.lengths[passage_id] = sum(terms.values())
+            self.total_length += self.lengths[passage_id]
+            if vector is not None:
+                self.vectors[passage_id] = vector
+    
+    def search(self, query, top_k=RETRIEVAL_TOP_K, query_vector=None):
+        with self.lock:
+            passage_count = len(self.lengths)
+            if not passage_count:
+                return []
+            
+            average_length = self.total_length / passage_count
+            scores = {}
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (passage_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for passage_id, frequency in postings.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[passage_id] / average_length)
+                    scores[passage_id] = scores.get(passage_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+            
+            if query_vector is not None and self.vectors:
+                # Blend in cosine similarity, scaled to the best BM25 score so neither signal dominates
+                import numpy as np
+                ids = list(self.vectors)
+                matrix = np.stack([self.vectors[passage_id] for passage_id in ids])
+                similarities = matrix @ query_vector
+                scale = max(scores.values(), default=1.0)
+                for passage_id, similarity in zip(ids, similarities):
+                    scores[passage_id] = scores.get(passage_id, 0.0) + float(similarity) * scale
+            
+            return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+def embed_text(text, task_type):
+    import numpy as np
+    model = get_model()
+    if not model:
+        raise RuntimeError("Could not initialize the AI model for embeddings.")
+    result = model.embed_content(text, task_type)
+    vector = np.asarray(result.embeddings[0].values, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+@st.cache_resource(max_entries=256)
+def get_retrieval_index(owner):
+    # One index per user, so nobody's notes or answers reach another user's prompts. Each is built from
+    # the database on first use and then kept up to date incrementally; evicted ones are simply rebuilt.
+    index = RetrievalIndex()
+    with db_transaction() as conn:
+        rows = conn.execute(
+            "SELECT passages.id, COALESCE(passages.text, document_chunks.text) AS text, passages.embedding FROM passages "
+            "LEFT JOIN document_chunks ON document_chunks.doc_hash = passages.doc_hash AND document_chunks.idx = passages.idx "
+            "WHERE passages.owner = ?",
+            (owner,)
+        ).fetchall()
+    
+    for row in rows:
+        vector = None
+        if USE_EMBEDDINGS and row['embedding'] is not None:
+            import numpy as np
+            vector = np.frombuffer(row['embedding'], dtype=np.float32)
+        index.add(row['id'], row['text'] or '', vector)
+    return index
+
+def add_passage(owner, source, text=None, doc_hash=None, idx=None):
+    if doc_hash is not None:
+        text = get_document_chunk(doc_hash, idx)
+    
+    vector = None
+    if USE_EMBEDDINGS:
+        try:
+            vector = embed_text(text, "RETRIEVAL_DOCUMENT")
+        except Exception as e:
+            if st.session_state.get('debug_mode'):
+                st.warning(f"Error embedding passage: {str(e)}")
+    
+    # Fetched before the insert: an index built on a cache miss loads every stored passage, and adding
+    # the new one on top of that would count it twice
+    index = get_retrieval_index(owner)
+    with db_transaction() as conn:
+        passage_id = conn.execute(
+            "INSERT INTO passages (source, doc_hash, idx, text, embedding, owner, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (source, doc_hash, idx, text if doc_hash is None else None,
+             vector.tobytes() if vector is not None else None, owner, int(time.time()))
+        ).lastrowid
+    index.add(passage_id, text, vector)
+
+def index_document(doc_hash):
+    owner = st.session_state['user_id']
+    document = get_document(doc_hash)
+    with db_transaction() as conn:
+        already_indexed = conn.execute("SELECT 1 FROM passages WHERE owner = ? AND doc_hash = ? LIMIT 1", (owner, doc_hash)).fetchone()
+    if already_indexed or not document or not document['chunks']:
+        return
+    
+    for idx in range(document['chunks']):
+        add_passage(owner, document['name'], doc_hash=doc_hash, idx=idx)
+
+def index_output(text, source):
+    # Only keep real answers; failed generations come back as error messages
+    if text and not text.startswith(("Error:", "Failed to")):
+        add_passage(st.session_state['user_id'], source, text=text)
+
+def retrieve_passages(query, top_k=RETRIEVAL_TOP_K, token_budget=RETRIEVAL_TOKEN_BUDGET):
+    query_vector = None
+    if USE_EMBEDDINGS:
+        try:
+            query_vector = embed_text(query, "RETRIEVAL_QUERY")
+        except Exception as e:
+            if st.session_state.get('debug_mode'):
+                st.warning(f"Error embedding question: {str(e)}")
+    
+    owner = st.session_state['user_id']
+    ranked = get_retrieval_index(owner).search(query, top_k, query_vector)
+    if not ranked:
+        return []
+    
+    with db_transaction() as conn:
+        rows = {
+            row['id']: row for row in conn.execute(
+                "SELECT passages.id, passages.source, COALESCE(passages.text, document_chunks.text) AS text FROM passages "
+                "LEFT JOIN document_chunks ON document_chunks.doc_hash = passages.doc_hash AND document_chunks.idx = passages.idx "
+                f"WHERE passages.owner = ? AND passages.id IN ({','.join('?' * len(ranked))})",
+                [owner, *(passage_id for passage_id, _ in ranked)]
+            ).fetchall()
+        }
+    
+    # Keep the best passages that fit in the budget
+    passages = []
+    used_tokens = 0
+    for passage_id, _ in ranked:
+        row = rows.get(passage_id)
+        if row is None:
+            continue
+        tokens = estimate_tokens(row['text'])
+        if used_tokens + tokens > token_budget:
+            continue
+        passages.append({"source": row['source'], "text": row['text']})
+        used_tokens += tokens
+    return passages
+
+def solve_math_problem(problem):
     model = get_model()
     if not model:
         return "Error: Could not initialize the AI model. Please check your API key."
         
-    prompt = f"""
-    Please summarize the following text into 1-2 concise sentences that capture the key points.
-    Make the summary simple, clear, and easy to understand.
-    
-    TEXT TO SUMMARIZE:
-    {text}
-    """
+    prompt = render_prompt(("math", {"problem": truncate_to_tokens(problem, input_budget(("math", {})))}))
     
     try:
         response = model.generate_content(prompt)
@@ -291,30 +1841,22 @@ def summarize_text(text):
             return str(response)
     except Exception as e:
         st.error(f"API Error: {str(e)}")
-        return f"Failed to summarize text: {str(e)}"
+        return f"Failed to solve math problem: {str(e)}"
 
-def create_study_plan(topic, days=7):
+def answer_general_question(question):
     model = get_model()
     if not model:
         return "Error: Could not initialize the AI model. Please check your API key."
         
-    prompt = f"""
-    Create a {days}-day study plan for learning about {topic}.
-    For each day, include:
-    1. Main focus/objective for the day
-    2. Key concepts to study
-    3. Suggested activities or exercises
-    4. Estimated time needed
-    
-    Format the output as follows for each day:
-    Day 1:
-    Focus: [Main objective]
-    Concepts: [Key concepts]
-    Activities: [Suggested activities]
-    Time: [Estimated time in hours]
+    # Retrieved excerpts are capped by their own budget, so the question gets whatever remains
+    grounding = None
+    passages = retrieve_passages(question)
+    if passages:
+        excerpts = "\n\n".join(f"[{passage['source']}]\n{passage['text']}" for passage in passages)
+        grounding = ("grounding", {"excerpts": excerpts})
     
-    Separate each day with a blank line.
-    """
+    limit = input_budget(("general_answer", {}), grounding)
+    prompt = render_prompt(("general_answer", {"question": truncate_to_tokens(question, limit)}), grounding)
     
     try:
         response = model.generate_content(prompt)
@@ -326,71 +1868,293 @@ def create_study_plan(topic, days=7):
             return str(response)
     except Exception as e:
         st.error(f"API Error: {str(e)}")
-        return f"Failed to create study plan: {str(e)}"
+        return f"Failed to answer question: {str(e)}"
 
-def solve_math_problem(problem):
+@st.cache_resource
+def get_prefetch_executor():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="edubot-prefetch")
+
+def response_tokens(response, prompt, text):
+    usage = getattr(response, 'usage_metadata', None)
+    return getattr(usage, 'total_token_count', 0) or estimate_tokens(prompt) + estimate_tokens(text)
+
+def run_prefetch(kind, model, topic, count, source_text):
+    # Runs on a worker thread, so it only talks to the model. Parsing and the question bank
+    # touch st.session_state and the cached database, so take_prefetch does them on the script thread
+    started = time.perf_counter()
+    if kind == 'quiz':
+        prompt = quiz_prompt(topic, count, source_text)
+    elif kind == 'flashcards':
+        prompt = flashcards_prompt(topic, count, source_text)
+    else:
+        prompt = study_plan_prompt(topic, count, 1, count)
+    
+    response = model.generate_content(prompt)
+    text = extract_response_text(response)
+    return {"text": text, "seconds": time.perf_counter() - started, "tokens": response_tokens(response, prompt, text)}
+
+def start_prefetch(kind, topic, document_hash=None):
+    discard_prefetch()
+    
+    key = study_topic_key(topic, document_hash)
+    count = PREFETCH_COUNTS[kind]
+    if kind == 'quiz':
+        count -= count_bank_questions(key)
+        if count <= 0:
+            return
+    
     model = get_model()
     if not model:
-        return "Error: Could not initialize the AI model. Please check your API key."
-        
-    prompt = f"""
-    Please solve this math problem step by step:
-    {problem}
+        return
     
-    Provide a clear, detailed solution showing each step of your work.
-    If this involves calculus, algebra, or other mathematical concepts, explain the key principles involved.
-    Make your explanation understandable to a student learning this topic.
-    """
+    source_text = document_excerpt(document_hash) if document_hash else None
+    future = get_prefetch_executor().submit(run_prefetch, kind, model, topic, count, source_text)
+    st.session_state['prefetch'] = {"kind": kind, "topic": key, "count": count, "future": future, "started_at": time.time()}
+
+def record_wasted_prefetch(stats, future):
+    if not future.cancelled() and future.exception() is None:
+        stats['tokens_wasted'] += future.result()['tokens']
+        stats['tokens_used'] += future.result()['tokens']
+
+def discard_prefetch():
+    prefetch = st.session_state.get('prefetch')
+    if not prefetch:
+        return
     
-    try:
-        response = model.generate_content(prompt)
-        if hasattr(response, 'text'):
-            return response.text
-        elif hasattr(response, 'parts'):
-            return ''.join([part.text for part in response.parts])
-        else:
-            return str(response)
-    except Exception as e:
-        st.error(f"API Error: {str(e)}")
-        return f"Failed to solve math problem: {str(e)}"
+    st.session_state['prefetch'] = None
+    stats = st.session_state['prefetch_stats']
+    stats['discarded'] += 1
+    if not prefetch['future'].cancel():
+        # Already running: count its tokens as wasted once it finishes
+        prefetch['future'].add_done_callback(lambda future: record_wasted_prefetch(stats, future))
 
-def answer_general_question(question):
-    model = get_model()
-    if not model:
-        return "Error: Could not initialize the AI model. Please check your API key."
-        
-    prompt = f"""
-    You are EduBot, a friendly and helpful educational assistant. Answer the following question
-    in a conversational, helpful manner. If the question is outside the educational domain,
-    politely steer the conversation back to education.
+def expire_prefetch():
+    prefetch = st.session_state.get('prefetch')
+    if prefetch and time.time() - prefetch['started_at'] > PREFETCH_TTL_SECONDS:
+        discard_prefetch()
+
+def take_prefetch(kind, topic, count, document_hash=None):
+    key = study_topic_key(topic, document_hash)
+    prefetch = st.session_state.get('prefetch')
+    if not prefetch or prefetch['kind'] != kind or prefetch['topic'] != key:
+        return None
     
-    Question: {question}
-    """
+    # A 7-day plan can't be cut down to another length; quizzes and flashcards can be truncated
+    if kind == 'study_plan' and count != prefetch['count']:
+        discard_prefetch()
+        return None
+    
+    st.session_state['prefetch'] = None
+    stats = st.session_state['prefetch_stats']
     
+    waited_from = time.perf_counter()
     try:
-        response = model.generate_content(prompt)
-        if hasattr(response, 'text'):
-            return response.text
-        elif hasattr(response, 'parts'):
-            return ''.join([part.text for part in response.parts])
-        else:
-            return str(response)
+        outcome = prefetch['future'].result(timeout=PREFETCH_TTL_SECONDS)
     except Exception as e:
-        st.error(f"API Error: {str(e)}")
-        return f"Failed to answer question: {str(e)}"
+        stats['misses'] += 1
+        if st.session_state['debug_mode']:
+            st.warning(f"Prefetch failed: {str(e)}")
+        return None
+    waited = time.perf_counter() - waited_from
+    
+    stats['hits'] += 1
+    stats['seconds_saved'] += max(0.0, outcome['seconds'] - waited)
+    stats['tokens_used'] += outcome['tokens']
+    
+    if kind == 'quiz':
+        # Questions go into the bank, where assemble_quiz will find them
+        result = parse_quiz(outcome['text'])
+        add_questions_to_bank(key, result)
+    elif kind == 'flashcards':
+        result = parse_flashcards(outcome['text'])
+    else:
+        result = parse_study_plan(outcome['text'])
+
+    # A hit still wastes the share of the prefetch that goes beyond what was asked for, like the 7 unused
+    # cards of a 10-card prefetch when 3 were requested
+    if len(result) > count:
+        stats['tokens_wasted'] += round(outcome['tokens'] * (1 - count / len(result)))
+    return result
+
+class Classroom:
+    # A published quiz and its leaderboard. The leaderboard is a list kept sorted by rank key,
+    # so each answer moves one entry with bisect instead of re-sorting every participant
+    def __init__(self, code, topic, questions):
+        self.code = code
+        self.topic = topic
+        self.questions = tuple(questions)
+        self.created_at = time.time()
+        self.closed = False
+        self.participants = {}
+        self.leaderboard = []
+        self.finished = 0
+        self.lock = threading.Lock()
+    
+    def join(self, name):
+        with self.lock:
+            if self.closed or name in self.participants:
+                return False
+            participant = self.participants[name] = ClassroomParticipant(name, reached_at=time.monotonic())
+            bisect.insort(self.leaderboard, participant.rank_key())
+            return True
+    
+    def record_answer(self, name, correct):
+        with self.lock:
+            participant = self.participants.get(name)
+            if self.closed or participant is None or participant.answered >= len(self.questions):
+                return
+            participant.answered += 1
+            self.finished += participant.answered == len(self.questions)
+            if correct:
+                del self.leaderboard[bisect.bisect_left(self.leaderboard, participant.rank_key())]
+                participant.score += 1
+                participant.reached_at = time.monotonic()
+                bisect.insort(self.leaderboard, participant.rank_key())
+    
+    def rank(self, name):
+        with self.lock:
+            participant = self.participants.get(name)
+            return bisect.bisect_left(self.leaderboard, participant.rank_key()) + 1 if participant else None
+    
+    def standings(self, limit=CLASSROOM_LEADERBOARD_SIZE):
+        with self.lock:
+            top = [self.participants[key[2]] for key in self.leaderboard[:limit]]
+            return [(participant.name, participant.score, participant.answered) for participant in top], len(self.participants), self.finished
+
+class ClassroomRegistry:
+    # Shared by every session in the process through st.cache_resource
+    def __init__(self):
+        self.classrooms = {}
+        self.lock = threading.Lock()
+    
+    def open(self, topic, questions):
+        with self.lock:
+            now = time.time()
+            for code in [code for code, classroom in self.classrooms.items() if now - classroom.created_at > CLASSROOM_TTL_SECONDS]:
+                self.classrooms.pop(code).closed = True
+            
+            code = ''.join(random.choices(CLASSROOM_CODE_ALPHABET, k=6))
+            while code in self.classrooms:
+                code = ''.join(random.choices(CLASSROOM_CODE_ALPHABET, k=6))
+            classroom = self.classrooms[code] = Classroom(code, topic, questions)
+            return classroom
+    
+    def get(self, code):
+        with self.lock:
+            return self.classrooms.get(code.upper())
+    
+    def close(self, code):
+        with self.lock:
+            classroom = self.classrooms.pop(code, None)
+        if classroom:
+            with classroom.lock:
+                classroom.closed = True
+
+@st.cache_resource
+def get_classrooms():
+    return ClassroomRegistry()
+
+def host_classroom(topic):
+    if not topic:
+        return "Tell me the topic for your class, for example: 'Start a classroom quiz on photosynthesis'."
+    
+    with st.spinner("Generating the class quiz..."):
+        questions = assemble_quiz(topic, CLASSROOM_QUESTIONS)
+    if not questions:
+        return f"I'm sorry, I couldn't generate a quiz about {topic} at the moment. Could you try another topic or try again later?"
+    
+    classroom = get_classrooms().open(topic, questions)
+    st.session_state['classroom'] = {"code": classroom.code, "role": "teacher", "name": None}
+    save_study_session("quiz", topic)
+    return (
+        f"Your classroom quiz on {topic} is live with {len(questions)} questions! 🏫\n\n"
+        f"Class code: **{classroom.code}**\n\n"
+        f"Students join by typing: `join class {classroom.code} as <their name>`. "
+        "The leaderboard updates below as answers come in. Type 'end class' when you're done."
+    )
+
+def join_classroom(code, name):
+    classroom = get_classrooms().get(code)
+    if not classroom:
+        return f"I couldn't find an open classroom with the code {code.upper()}. Please check the code with your teacher."
+    if not name:
+        return f"What name should appear on the leaderboard? Type: `join class {classroom.code} as <your name>`."
+    if not classroom.join(name):
+        return f"Someone in classroom {classroom.code} is already called {name}. Please join with a different name."
+    
+    st.session_state['classroom'] = {"code": classroom.code, "role": "student", "name": name}
+    st.session_state.quiz_questions = list(classroom.questions)
+    st.session_state.quiz_active = True
+    st.session_state['quiz_feedback'] = None
+    st.session_state.current_question = 0
+    st.session_state.score = 0
+    st.session_state.answered = [False] * len(classroom.questions)
+    st.session_state['pending_quiz_topic'] = classroom.topic
+    return f"Welcome to classroom {classroom.code}, {name}! Here's the class quiz on {classroom.topic}.\n\n{format_quiz_question(classroom.questions[0], 1)}"
+
+def leave_classroom():
+    membership = st.session_state['classroom']
+    if not membership:
+        return "You're not in a classroom right now."
+    
+    st.session_state['classroom'] = None
+    if membership['role'] == 'teacher':
+        get_classrooms().close(membership['code'])
+        return f"Classroom {membership['code']} has ended. Thanks for teaching with EduBot!"
+    st.session_state.quiz_active = False
+    return f"You've left classroom {membership['code']}."
+
+def handle_classroom_leave(user_input):
+    if st.session_state['classroom'] and detect_intent(user_input)[0] == Intent.CLASSROOM_LEAVE:
+        return leave_classroom()
+    return None
 
 def detect_intent(user_input):
     user_input_lower = user_input.lower()
     
+    # Check for flashcard review intent (no generation needed)
+    review_keywords = ['review flashcards', 'review my flashcards', 'review cards', 'due cards', 'due flashcards', 'review deck']
+    if any(keyword in user_input_lower for keyword in review_keywords):
+        topic_match = re.search(r'(?:about|on) ([^?.,!]*)(?:\?|$|,|\.)', user_input_lower)
+        return Intent.REVIEW, {'topic': topic_match.group(1).strip() if topic_match else None}
+    
+    # Check for classroom quizzes before ordinary quizzes
+    join_match = re.search(r'\bjoin (?:the )?class(?:room)?(?: quiz)? ([a-z0-9]{6})\b(?:\s+as\s+(.+))?', user_input, re.IGNORECASE)
+    if join_match:
+        return Intent.CLASSROOM_JOIN, {'code': join_match.group(1), 'name': (join_match.group(2) or '').strip(" .!") or None}
+    
+    if re.search(r'\b(?:leave|end|close) (?:the )?class(?:room)?\b', user_input_lower):
+        return Intent.CLASSROOM_LEAVE, {}
+    
+    host_match = re.search(r'\b(?:start|host|run|create|open) (?:a |the )?class(?:room)? quiz\b(?:\s+(?:about|on)\s+([^?.,!]*))?', user_input_lower)
+    if host_match:
+        return Intent.CLASSROOM_HOST, {'topic': (host_match.group(1) or '').strip() or None}
+    
+    # Check for edits to the current study plan
+    adjust_match = re.search(r'(?:regenerate|redo|adjust|change|rewrite|update) day (\d+)(?:\s*(?:-|to|through)\s*(\d+))?', user_input_lower)
+    if adjust_match:
+        start_day = int(adjust_match.group(1))
+        end_day = int(adjust_match.group(2) or start_day)
+        instructions = user_input[adjust_match.end():].strip(" :,-")
+        return Intent.STUDY_PLAN_ADJUST, {'start_day': start_day, 'end_day': end_day, 'instructions': instructions}
+    
+    extend_match = re.search(r'extend (?:my |the |this )?(?:study )?plan (?:by |for )?(\d+)(?: more)? days?', user_input_lower)
+    if extend_match:
+        return Intent.STUDY_PLAN_EXTEND, {'days': int(extend_match.group(1))}
+    
+    references_document = any(keyword in user_input_lower for keyword in DOCUMENT_KEYWORDS)
+    
     # Check for flashcards intent
     flashcard_keywords = ['flashcard', 'flash card', 'flash cards', 'flashcards', 'create flashcards']
     if any(keyword in user_input_lower for keyword in flashcard_keywords):
+        if references_document:
+            return Intent.FLASHCARDS, {'document': True}
         topic_match = re.search(r'(?:about|on) ([^?.,!]*)(?:\?|$|,|\.)', user_input_lower)
         if topic_match:
             topic = topic_match.group(1).strip()
-            return 'flashcards', {'topic': topic}
+            return Intent.FLASHCARDS, {'topic': topic}
         else:
-            return 'flashcards_prompt', {}
+            return Intent.FLASHCARDS_PROMPT, {}
     
     # Check for study plan intent
     study_plan_keywords = ['study plan', 'learning plan', 'study schedule', 'create a plan', 'learning schedule']
@@ -398,9 +2162,9 @@ def detect_intent(user_input):
         topic_match = re.search(r'(?:about|on|for|studying) ([^?.,!]*)(?:\?|$|,|\.)', user_input_lower)
         if topic_match:
             topic = topic_match.group(1).strip()
-            return 'study_plan', {'topic': topic}
+            return Intent.STUDY_PLAN, {'topic': topic}
         else:
-            return 'study_plan_prompt', {}
+            return Intent.STUDY_PLAN_PROMPT, {}
     
     # Check for pomodoro intent
     pomodoro_keywords = ['pomodoro', 'timer', 'study timer', 'focus timer', 'start timer']
@@ -408,61 +2172,100 @@ def detect_intent(user_input):
         duration_match = re.search(r'(\d+) minutes', user_input_lower)
         if duration_match:
             duration = int(duration_match.group(1))
-            return 'pomodoro', {'duration': duration}
+            return Intent.POMODORO, {'duration': duration}
         else:
-            return 'pomodoro_prompt', {}
+            return Intent.POMODORO_PROMPT, {}
     
     # Check for quiz intent
     quiz_keywords = ['quiz', 'test', 'questions', 'make a quiz', 'create a quiz', 'generate a quiz']
     if any(keyword in user_input_lower for keyword in quiz_keywords):
+        if references_document:
+            return Intent.QUIZ, {'document': True}
         topic_match = re.search(r'(?:about|on) ([^?.,!]*)(?:\?|$|,|\.)', user_input_lower)
         if topic_match:
             topic = topic_match.group(1).strip()
-            return 'quiz', {'topic': topic}
+            return Intent.QUIZ, {'topic': topic}
         else:
-            return 'quiz_prompt', {}
+            return Intent.QUIZ_PROMPT, {}
     
     # Check for summarize intent
     summarize_keywords = ['summarize', 'summary', 'summarize this', 'condense', 'shorten']
     if any(keyword in user_input_lower for keyword in summarize_keywords):
-        if len(user_input.split()) > 30:
-            return 'summarize', {'text': user_input}
+        if references_document:
+            return Intent.DOCUMENT_SUMMARY, {'document': True}
+        elif len(user_input.split()) > 30:
+            return Intent.SUMMARIZE, {'text': user_input}
         else:
-            return 'summarize_prompt', {}
+            return Intent.SUMMARIZE_PROMPT, {}
     
     # Check for math problem intent
     math_keywords = ['solve', 'math', 'problem', 'equation', 'calculate', 'find', '=', '+', '-', '*', '/', 'algebra', 'calculus']
     if any(keyword in user_input_lower for keyword in math_keywords) and any(c.isdigit() for c in user_input):
-        return 'math', {'problem': user_input}
+        return Intent.MATH, {'problem': user_input}
     
     # Default to general question
-    return 'general', {'question': user_input}
+    return Intent.GENERAL, {'question': user_input}
 
 def process_user_message(user_input):
     try:
         intent, params = detect_intent(user_input)
+        document = st.session_state.get('active_document')
         
-        if intent == 'flashcards':
-            topic = params.get('topic')
+        if params.get('document') and not document:
+            response = "Please upload a PDF or notes file under 'Study Materials' in the sidebar first, then ask me again."
+        
+        elif intent == Intent.DOCUMENT_SUMMARY:
+            with st.spinner(f"Summarizing {document['name']}..."):
+                summary = summarize_document(document['hash'])
+            index_output(summary, f"Summary of {document['name']}")
+            save_study_session("summary", document['name'])
+            response = f"Here's a summary of {document['name']}:\n\n{summary}\n\nWould you like a quiz or flashcards on this material?"
+        
+        elif intent == Intent.FLASHCARDS:
+            topic = document['name'] if params.get('document') else params.get('topic')
             response = f"I'd be happy to create flashcards about {topic}! How many flashcards would you like (1-10)?"
             st.session_state['pending_flashcards_topic'] = topic
+            st.session_state['pending_flashcards_document'] = document['hash'] if params.get('document') else None
             st.session_state['waiting_for_flashcards_count'] = True
+            start_prefetch('flashcards', topic, st.session_state['pending_flashcards_document'])
         
-        elif intent == 'flashcards_prompt':
+        elif intent == Intent.REVIEW:
+            response = start_flashcard_review(params.get('topic'))
+        
+        elif intent == Intent.FLASHCARDS_PROMPT:
             response = "I'd be happy to create flashcards for you! What topic would you like the flashcards to be about?"
             st.session_state['waiting_for_flashcards_topic'] = True
         
-        elif intent == 'study_plan':
+        elif intent == Intent.STUDY_PLAN:
             topic = params.get('topic')
             response = f"I'd be happy to create a study plan for learning about {topic}! How many days would you like the plan to cover (1-14)?"
             st.session_state['pending_study_plan_topic'] = topic
             st.session_state['waiting_for_study_plan_days'] = True
+            start_prefetch('study_plan', topic)
+        
+        elif intent in (Intent.STUDY_PLAN_ADJUST, Intent.STUDY_PLAN_EXTEND) and not st.session_state.get('current_study_plan_id'):
+            response = "You don't have a study plan yet. Ask me to create one first, for example: 'Create a study plan for calculus'."
+        
+        elif intent == Intent.STUDY_PLAN_ADJUST:
+            with st.spinner("Updating your study plan..."):
+                response = regenerate_study_plan_days(
+                    st.session_state['current_study_plan_id'],
+                    params.get('start_day'), params.get('end_day'), params.get('instructions')
+                )
+        
+        elif intent == Intent.STUDY_PLAN_EXTEND:
+            extra_days = params.get('days', 7)
+            if 1 <= extra_days <= 14:
+                with st.spinner("Extending your study plan..."):
+                    response = extend_study_plan(st.session_state['current_study_plan_id'], extra_days)
+            else:
+                response = "I can extend your plan by 1 to 14 days at a time."
         
-        elif intent == 'study_plan_prompt':
+        elif intent == Intent.STUDY_PLAN_PROMPT:
             response = "I'd be happy to create a study plan for you! What topic would you like to study?"
             st.session_state['waiting_for_study_plan_topic'] = True
         
-        elif intent == 'pomodoro':
+        elif intent == Intent.POMODORO:
             duration = params.get('duration', 25)
             if duration < 1:
                 duration = 25
@@ -475,37 +2278,51 @@ def process_user_message(user_input):
             
             response = f"I've started a {duration}-minute Pomodoro timer for you! Focus on your work, and I'll let you know when time is up."
         
-        elif intent == 'pomodoro_prompt':
+        elif intent == Intent.POMODORO_PROMPT:
             response = "I'd be happy to set a Pomodoro timer for you! How many minutes would you like to focus for (1-60)?"
             st.session_state['waiting_for_pomodoro_duration'] = True
         
-        elif intent == 'quiz':
-            topic = params.get('topic')
+        elif intent == Intent.QUIZ:
+            topic = document['name'] if params.get('document') else params.get('topic')
             response = f"I'd be happy to create a quiz about {topic}! How many questions would you like (1-5)?"
             st.session_state['pending_quiz_topic'] = topic
+            st.session_state['pending_quiz_document'] = document['hash'] if params.get('document') else None
             st.session_state['waiting_for_quiz_count'] = True
+            start_prefetch('quiz', topic, st.session_state['pending_quiz_document'])
         
-        elif intent == 'quiz_prompt':
+        elif intent == Intent.QUIZ_PROMPT:
             response = "I'd be happy to create a quiz for you! What topic would you like the quiz to be about?"
             st.session_state['waiting_for_quiz_topic'] = True
         
-        elif intent == 'summarize':
+        elif intent == Intent.CLASSROOM_HOST:
+            response = host_classroom(params.get('topic'))
+        
+        elif intent == Intent.CLASSROOM_JOIN:
+            response = join_classroom(params.get('code'), params.get('name'))
+        
+        elif intent == Intent.CLASSROOM_LEAVE:
+            response = leave_classroom()
+        
+        elif intent == Intent.SUMMARIZE:
             text = params.get('text')
             summary = summarize_text(text)
+            index_output(summary, "EduBot summary")
             response = f"Here's a summary of what you shared:\n\n{summary}\n\nIs there anything else you'd like me to explain or summarize?"
         
-        elif intent == 'summarize_prompt':
+        elif intent == Intent.SUMMARIZE_PROMPT:
             response = "I'd be happy to summarize some text for you! Please share the passage you'd like me to summarize."
             st.session_state['waiting_for_summarize_text'] = True
         
-        elif intent == 'math':
+        elif intent == Intent.MATH:
             problem = params.get('problem')
             solution = solve_math_problem(problem)
+            index_output(solution, "EduBot math solution")
             response = f"Here's the solution to your math problem:\n\n{solution}\n\nDo you have any other problems you'd like me to solve?"
         
         else:  # general question
             question = params.get('question')
             response = answer_general_question(question)
+            index_output(response, "EduBot answer")
         
         return response
     except Exception as e:
@@ -518,8 +2335,10 @@ def handle_flashcards_flow(user_input):
     if 'waiting_for_flashcards_topic' in st.session_state and st.session_state['waiting_for_flashcards_topic']:
         topic = user_input
         st.session_state['pending_flashcards_topic'] = topic
+        st.session_state['pending_flashcards_document'] = None
         st.session_state['waiting_for_flashcards_topic'] = False
         st.session_state['waiting_for_flashcards_count'] = True
+        start_prefetch('flashcards', topic)
         return f"Great! I'll create flashcards about {topic}. How many flashcards would you like (1-10)?"
     
     elif 'waiting_for_flashcards_count' in st.session_state and st.session_state['waiting_for_flashcards_count']:
@@ -529,20 +2348,29 @@ def handle_flashcards_flow(user_input):
                 topic = st.session_state['pending_flashcards_topic']
                 st.session_state['waiting_for_flashcards_count'] = False
                 
+                document_hash = st.session_state.get('pending_flashcards_document')
+                
                 with st.spinner("Generating your flashcards..."):
-                    flashcards_text = generate_flashcards(topic, num_cards)
-                    st.session_state['flashcards'] = parse_flashcards(flashcards_text)
+                    prefetched_cards = take_prefetch('flashcards', topic, num_cards, document_hash)
+                    if prefetched_cards:
+                        st.session_state['flashcards'] = prefetched_cards[:num_cards]
+                    else:
+                        source_text = document_excerpt(document_hash) if document_hash else None
+                        flashcards_text = generate_flashcards(topic, num_cards, source_text)
+                        st.session_state['flashcards'] = parse_flashcards(flashcards_text)
                     
                     if not st.session_state['flashcards'] or len(st.session_state['flashcards']) == 0:
                         return f"I'm sorry, I couldn't generate flashcards about {topic} at the moment. Could you try another topic or try again later?"
                     
                     st.session_state['flashcard_active'] = True
+                    st.session_state['flashcard_review'] = False
                     st.session_state['flashcard_index'] = 0
                     st.session_state['current_card_flipped'] = False
+                    save_flashcard_deck(st.session_state['user_id'], study_topic_key(topic, document_hash), st.session_state['flashcards'])
                 
                 card = st.session_state['flashcards'][0]
                 save_study_session("flashcards", topic)
-                return f"Here are your flashcards on {topic}!\n\n**Card 1 (Front):** {card['front']}\n\nType 'flip' to see the back of the card, 'next' for the next card, or 'exit' to finish studying."
+                return f"Here are your flashcards on {topic}! They've been saved to your deck, so you can type 'review flashcards' any time to study them with spaced repetition.\n\n**Card 1 (Front):** {card.front}\n\nType 'flip' to see the back of the card, 'next' for the next card, or 'exit' to finish studying."
             else:
                 return "Please choose a number between 1 and 10."
         except ValueError:
@@ -560,6 +2388,7 @@ def handle_study_plan_flow(user_input):
         st.session_state['pending_study_plan_topic'] = topic
         st.session_state['waiting_for_study_plan_topic'] = False
         st.session_state['waiting_for_study_plan_days'] = True
+        start_prefetch('study_plan', topic)
         return f"Great! I'll create a study plan for {topic}. How many days would you like the plan to cover (1-14)?"
     
     elif 'waiting_for_study_plan_days' in st.session_state and st.session_state['waiting_for_study_plan_days']:
@@ -570,10 +2399,10 @@ def handle_study_plan_flow(user_input):
                 st.session_state['waiting_for_study_plan_days'] = False
                 
                 with st.spinner("Creating your study plan..."):
-                    study_plan = create_study_plan(topic, days)
+                    study_plan = create_study_plan(topic, days, take_prefetch('study_plan', topic, days))
                 
                 save_study_session("study_plan", topic)
-                return f"Here's your {days}-day study plan for learning about {topic}:\n\n{study_plan}\n\nIs there anything you'd like me to explain or adjust about this plan?"
+                return f"Here's your {days}-day study plan for learning about {topic}:\n\n{study_plan}\n\nIs there anything you'd like me to adjust? You can say things like 'change day 3 to include more practice' or 'extend my plan by 3 days'."
             else:
                 return "Please choose a number between 1 and 14 days."
         except ValueError:
@@ -614,33 +2443,60 @@ def handle_flashcard_interaction(user_input):
         
         if current_index >= total_cards:
             st.session_state['flashcard_active'] = False
+            st.session_state['flashcard_review'] = False
             return "You've gone through all the flashcards! Would you like to create another set on a different topic?"
         
         current_card = st.session_state['flashcards'][current_index]
         user_command = user_input.strip().lower()
         
+        reviewing = st.session_state.get('flashcard_review', False)
+        
         if user_command == 'flip':
             st.session_state['current_card_flipped'] = not st.session_state['current_card_flipped']
             side = "Back" if st.session_state['current_card_flipped'] else "Front"
-            content = current_card['back'] if st.session_state['current_card_flipped'] else current_card['front']
+            content = current_card.back if st.session_state['current_card_flipped'] else current_card.front
             
+            if reviewing:
+                return f"**Card {current_index + 1} ({side}):** {content}\n\nHow well did you know it? Type 'again', 'hard', 'good', or 'easy' (or 'exit' to finish reviewing)."
             return f"**Card {current_index + 1} ({side}):** {content}\n\nType 'flip' to see the other side, 'next' for the next card, or 'exit' to finish studying."
         
+        elif reviewing and user_command in REVIEW_GRADES:
+            review_card(st.session_state['user_id'], current_card, REVIEW_GRADES[user_command])
+            if user_command == 'again':
+                # Show lapsed cards once more before the review ends
+                st.session_state['flashcards'].append(current_card)
+            
+            st.session_state['flashcard_index'] += 1
+            st.session_state['current_card_flipped'] = False
+            
+            if st.session_state['flashcard_index'] >= len(st.session_state['flashcards']):
+                st.session_state['flashcard_active'] = False
+                st.session_state['flashcard_review'] = False
+                return "Review complete! Each card has been rescheduled based on your ratings. Come back when more cards are due."
+            
+            next_card = st.session_state['flashcards'][st.session_state['flashcard_index']]
+            return f"**Card {st.session_state['flashcard_index'] + 1} (Front):** {next_card.front}\n\nType 'flip' to see the back, then rate yourself with 'again', 'hard', 'good', or 'easy'."
+        
         elif user_command == 'next':
             st.session_state['flashcard_index'] += 1
             st.session_state['current_card_flipped'] = False
             
             if st.session_state['flashcard_index'] >= total_cards:
                 st.session_state['flashcard_active'] = False
+                st.session_state['flashcard_review'] = False
                 return "You've gone through all the flashcards! Would you like to create another set on a different topic?"
             
             next_card = st.session_state['flashcards'][st.session_state['flashcard_index']]
-            return f"**Card {st.session_state['flashcard_index'] + 1} (Front):** {next_card['front']}\n\nType 'flip' to see the back of the card, 'next' for the next card, or 'exit' to finish studying."
+            return f"**Card {st.session_state['flashcard_index'] + 1} (Front):** {next_card.front}\n\nType 'flip' to see the back of the card, 'next' for the next card, or 'exit' to finish studying."
         
         elif user_command == 'exit':
             st.session_state['flashcard_active'] = False
+            st.session_state['flashcard_review'] = False
             return "Flashcard study session ended. What would you like to do next?"
         
+        elif reviewing:
+            return "Please type 'flip', 'again', 'hard', 'good', 'easy', 'next', or 'exit'."
+        
         else:
             return "Please type 'flip', 'next', or 'exit'."
     
@@ -650,8 +2506,10 @@ def handle_quiz_flow(user_input):
     if 'waiting_for_quiz_topic' in st.session_state and st.session_state['waiting_for_quiz_topic']:
         topic = user_input
         st.session_state['pending_quiz_topic'] = topic
+        st.session_state['pending_quiz_document'] = None
         st.session_state['waiting_for_quiz_topic'] = False
         st.session_state['waiting_for_quiz_count'] = True
+        start_prefetch('quiz', topic)
         return f"Great! I'll create a quiz about {topic}. How many questions would you like (1-5)?"
     
     elif 'waiting_for_quiz_count' in st.session_state and st.session_state['waiting_for_quiz_count']:
@@ -661,23 +2519,24 @@ def handle_quiz_flow(user_input):
                 topic = st.session_state['pending_quiz_topic']
                 st.session_state['waiting_for_quiz_count'] = False
                 
+                document_hash = st.session_state.get('pending_quiz_document')
+                
                 with st.spinner("Generating your quiz..."):
-                    quiz_text = generate_quiz(topic, num_questions)
-                    st.session_state.quiz_questions = parse_quiz(quiz_text)
+                    # A prefetched quiz lands in the question bank, so just wait for it
+                    take_prefetch('quiz', topic, num_questions, document_hash)
+                    st.session_state.quiz_questions = assemble_quiz(topic, num_questions, document_hash)
                     
                     if not st.session_state.quiz_questions or len(st.session_state.quiz_questions) == 0:
                         return f"I'm sorry, I couldn't generate a quiz about {topic} at the moment. Could you try another topic or try again later?"
                     
                     st.session_state.quiz_active = True
+                    st.session_state['quiz_feedback'] = None
                     st.session_state.current_question = 0
                     st.session_state.score = 0
                     st.session_state.answered = [False] * len(st.session_state.quiz_questions)
                 
-                current_q = st.session_state.quiz_questions[0]
-                options_text = "\n".join([f"{k}: {v}" for k, v in current_q['options'].items()])
-                
                 save_study_session("quiz", topic)
-                return f"Here's your quiz on {topic}!\n\n**Question 1:** {current_q['question']}\n\n{options_text}\n\nReply with just the letter of your answer (A, B, C, or D)."
+                return f"Here's your quiz on {topic}!\n\n{format_quiz_question(st.session_state.quiz_questions[0], 1)}"
             else:
                 return "Please choose a number between 1 and 5."
         except ValueError:
@@ -713,14 +2572,21 @@ def handle_quiz_answer(user_input):
         
         if len(user_answer) == 1 and user_answer in "ABCD":
             current_q = st.session_state.quiz_questions[st.session_state.current_question]
-            correct_answer = current_q['answer']
+            correct_answer = current_q.answer
+            
+            membership = st.session_state['classroom']
+            if membership and membership['role'] == 'student':
+                classroom = get_classrooms().get(membership['code'])
+                if classroom:
+                    classroom.record_answer(membership['name'], user_answer == correct_answer)
             
             if user_answer == correct_answer:
                 st.session_state.score += 1
-                response = f"✅ Correct! {current_q.get('explanation', '')}"
+                response = f"✅ Correct! {current_q.explanation}"
             else:
-                response = f"❌ Not quite. The correct answer is {correct_answer}. {current_q.get('explanation', '')}"
+                response = f"❌ Not quite. The correct answer is {correct_answer}. {current_q.explanation}"
                 
+            st.session_state['quiz_feedback'] = response
             st.session_state.answered[st.session_state.current_question] = True
             st.session_state.current_question += 1
             
@@ -739,11 +2605,10 @@ def handle_quiz_answer(user_input):
                 st.session_state.quiz_active = False
                 
                 topic = st.session_state.get('pending_quiz_topic', 'unknown')
-                save_study_session("quiz", topic, score=f"{st.session_state.score}/{len(st.session_state.quiz_questions)}")
+                save_study_session("quiz", topic, correct=st.session_state.score, total=len(st.session_state.quiz_questions))
             else:
                 next_q = st.session_state.quiz_questions[st.session_state.current_question]
-                options_text = "\n".join([f"{k}: {v}" for k, v in next_q['options'].items()])
-                response += f"\n\n**Question {st.session_state.current_question + 1}:** {next_q['question']}\n\n{options_text}\n\nReply with just the letter of your answer (A, B, C, or D)."
+                response += f"\n\n{format_quiz_question(next_q, st.session_state.current_question + 1)}"
             
             return response
         else:
@@ -761,36 +2626,181 @@ def check_pomodoro_timer():
             st.session_state['pomodoro_active'] = False
             st.session_state['pomodoro_start_time'] = None
             
-            save_study_session("pomodoro", "Focus Session", duration=f"{st.session_state['pomodoro_duration']} minutes")
+            save_study_session("pomodoro", "Focus Session", duration=st.session_state['pomodoro_duration'])
             return f"⏰ Your {st.session_state['pomodoro_duration']}-minute Pomodoro timer is complete! Time to take a 5-minute break. Would you like to start another timer after your break?"
     
     return None
 
-def main():
-    st.set_page_config(
-        page_title="EduBot - Your Smart Study Helper",
-        page_icon="📚",
-        layout="wide"
-    )
-    
-    # Check if dark theme is enabled
-    if st.session_state['theme'] == 'dark':
-        st.markdown("""
-        <style>
-        body {
-            background-color: #1E1E1E;
-            color: #FFFFFF;
+def iter_batches(items, size=TRANSFER_BATCH_SIZE):
+    items = iter(items)
+    while batch := list(itertools.islice(items, size)):
+        yield batch
+
+def iter_rows(query, params=()):
+    # Keyset pagination on id: the database lock is released between pages, so a long export never stalls other sessions
+    last_id = 0
+    while True:
+        with db_transaction() as conn:
+            rows = conn.execute(query, (*params, last_id, TRANSFER_BATCH_SIZE)).fetchall()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1]['id']
+
+def history_export_rows(user_id):
+    for session in iter_study_history(user_id):
+        yield {
+            "time": datetime.datetime.fromtimestamp(session.timestamp).isoformat(),
+            "type": session.type.value,
+            "topic": session.topic,
+            "duration_minutes": session.duration,
+            "correct": session.correct,
+            "total": session.total,
         }
-        .stApp {
-            background-color: #1E1E1E;
+
+def flashcard_export_rows(owner):
+    query = (
+        "SELECT cards.id, decks.topic AS deck, front, back, ease, interval, repetitions, due "
+        "FROM cards JOIN decks ON decks.id = cards.deck_id WHERE cards.owner = ? AND cards.id > ? ORDER BY cards.id LIMIT ?"
+    )
+    for row in iter_rows(query, (owner,)):
+        yield {
+            "deck": row['deck'], "front": row['front'], "back": row['back'], "ease": row['ease'],
+            "interval": row['interval'], "repetitions": row['repetitions'],
+            "due": datetime.datetime.fromtimestamp(row['due']).isoformat()
         }
-        </style>
-        """, unsafe_allow_html=True)
+
+def question_export_rows():
+    query = (
+        "SELECT id, topic, question, option_a, option_b, option_c, option_d, answer, explanation "
+        "FROM questions WHERE id > ? ORDER BY id LIMIT ?"
+    )
+    for row in iter_rows(query):
+        yield {key: row[key] for key in row.keys() if key != 'id'}
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+def csv_lines(rows):
+    # One small buffer is reused for every line instead of building the whole file
+    buffer = io.StringIO()
+    writer = None
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(buffer, fieldnames=list(row))
+            writer.writeheader()
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+def anki_lines(rows):
+    # Anki's text import reads these header lines, so the file imports into one subdeck per EduBot deck
+    yield "#separator:tab\n#html:false\n#deck column:3\n"
+    for row in rows:
+        fields = (row['front'], row['back'], ANKI_DECK_PREFIX + row['deck'])
+        yield '\t'.join(' '.join(field.split()) for field in fields) + '\n'
+
+EXPORTS = {
+    "Study history": (lambda: history_export_rows(st.session_state['user_id']), {"JSONL": (jsonl_lines, "jsonl"), "CSV": (csv_lines, "csv")}),
+    "Flashcard decks": (lambda: flashcard_export_rows(st.session_state['user_id']), {"Anki (TSV)": (anki_lines, "txt"), "CSV": (csv_lines, "csv"), "JSONL": (jsonl_lines, "jsonl")}),
+    "Quiz questions": (question_export_rows, {"JSONL": (jsonl_lines, "jsonl"), "CSV": (csv_lines, "csv")}),
+}
+
+def export_data(dataset, export_format):
+    # st.download_button keeps the whole file in Streamlit's media store, so the export is built in memory
+    rows, formats = EXPORTS[dataset]
+    format_lines, extension = formats[export_format]
+    slug = dataset.lower().replace(' ', '-')
+    file_name = f"edubot-{slug}-{datetime.datetime.now():%Y%m%d-%H%M%S}.{extension}"
+    return file_name, ''.join(format_lines(rows())).encode('utf-8')
+
+def strip_anki_html(text):
+    text = re.sub(r'<br\s*/?>|</div>', '\n', text, flags=re.IGNORECASE)
+    return html.unescape(re.sub(r'<[^>]+>', '', text))
+
+def iter_deck_file(source, name):
+    # Yields (deck, Flashcard) pairs from Anki text exports, CSV or JSONL; deck is None when the file has no deck column
+    text = io.TextIOWrapper(source, encoding='utf-8-sig', errors='replace', newline='')
+    try:
+        if name.lower().endswith('.jsonl'):
+            for line in text:
+                if not line.strip():
+                    continue
+                # Lines that are valid JSON but not a card, such as a bare string or number, are skipped
+                record = json.loads(line)
+                if isinstance(record, list) and len(record) >= 2:
+                    yield None, Flashcard.from_row(record)
+                elif isinstance(record, dict) and record.get('front') and record.get('back'):
+                    yield record.get('deck'), Flashcard(record['front'], record['back'])
+            return
+        
+        separator = ',' if name.lower().endswith('.csv') else '\t'
+        strip_html = False
+        metadata_columns = {}
+        lines = iter(text)
+        first_line = next(lines, '')
+        while first_line.startswith('#'):
+            key, _, value = first_line[1:].strip().partition(':')
+            value = value.strip()
+            if key == 'separator':
+                separator = ANKI_SEPARATORS.get(value.lower(), value[:1] or separator)
+            elif key == 'html':
+                strip_html = value.lower() == 'true'
+            elif key in ANKI_METADATA_COLUMNS and value.isdigit():
+                metadata_columns[key] = int(value) - 1
+            first_line = next(lines, '')
+        
+        # Front and back are the first two columns Anki didn't mark as metadata
+        deck_column = metadata_columns.get('deck column')
+        front_column, back_column = [column for column in range(len(metadata_columns) + 2) if column not in metadata_columns.values()][:2]
+        reader = csv.reader(itertools.chain([first_line], lines), delimiter=separator)
+        for row in reader:
+            header = [cell.strip().lower() for cell in row]
+            if reader.line_num == 1 and 'front' in header and 'back' in header:
+                front_column, back_column = header.index('front'), header.index('back')
+                deck_column = header.index('deck') if 'deck' in header else deck_column
+                continue
+            if len(row) <= max(front_column, back_column) or not row[front_column].strip():
+                continue
+            deck = row[deck_column].strip() if deck_column is not None and deck_column < len(row) else None
+            if deck and deck.startswith(ANKI_DECK_PREFIX):
+                deck = deck[len(ANKI_DECK_PREFIX):]
+            front, back = row[front_column], row[back_column]
+            if strip_html:
+                front, back = strip_anki_html(front), strip_anki_html(back)
+            yield deck or None, Flashcard(front.strip(), back.strip())
+    finally:
+        # Leave the uploaded file open for Streamlit
+        text.detach()
+
+def import_flashcard_deck(owner, source, name, topic):
+    # Cards are saved batch by batch as they are parsed; rows without a deck go into topic
+    with db_transaction() as conn:
+        cards_before = conn.execute("SELECT COUNT(*) FROM cards WHERE owner = ?", (owner,)).fetchone()[0]
     
+    read = 0
+    decks = set()
+    for deck, group in itertools.groupby(iter_deck_file(source, name), key=lambda item: item[0] or topic):
+        decks.add(normalize_topic(deck))
+        for batch in iter_batches(card for _, card in group):
+            save_flashcard_deck(owner, deck, batch)
+            read += len(batch)
+    
+    with db_transaction() as conn:
+        added = conn.execute("SELECT COUNT(*) FROM cards WHERE owner = ?", (owner,)).fetchone()[0] - cards_before
+    return read, added, len(decks)
+
+HEADER_HTML = "<h1 class='main-header'>📚 EduBot - Your Smart Study Helper</h1>"
+
+@st.cache_data
+def build_theme_css(theme):
     # Change base layout based on theme
-    primary_color = "#1E88E5" if st.session_state['theme'] == 'light' else "#90CAF9"
+    primary_color = "#1E88E5" if theme == 'light' else "#90CAF9"
+    button_text_color = '#FFFFFF' if theme == 'light' else '#000000'
     
-    st.markdown(f"""
+    css = f"""
     <style>
     .main-header {{
         font-size: 2.5rem;
@@ -799,19 +2809,252 @@ def main():
     }}
     .stButton button {{
         background-color: {primary_color};
-        color: {'#FFFFFF' if st.session_state['theme'] == 'light' else '#000000'};
+        color: {button_text_color};
     }}
-    </style>
-    """, unsafe_allow_html=True)
+    """
+    
+    if theme == 'dark':
+        css += """
+    body {
+        background-color: #1E1E1E;
+        color: #FFFFFF;
+    }
+    .stApp {
+        background-color: #1E1E1E;
+    }
+    """
+    
+    return css + "</style>"
+
+def record_rerun_time():
+    metrics = st.session_state['perf_metrics']
+    metrics.append(time.perf_counter() - SCRIPT_START)
+    del metrics[:-20]
+    record_cpu_time("full rerun", SCRIPT_START_CPU)
+
+def record_cpu_time(scope, started):
+    # thread_time only counts this script thread, so other sessions don't skew the numbers
+    samples = st.session_state['cpu_metrics'].setdefault(scope, [])
+    samples.append(time.thread_time() - started)
+    del samples[:-20]
+
+def queue_prompt(prompt):
+    st.session_state['queued_prompt'] = prompt
+
+def answer_quiz_from_panel(letter):
+    st.session_state.messages.append(ChatMessage(Role.USER, letter))
+    response = handle_quiz_answer(letter)
+    st.session_state.messages.append(ChatMessage(Role.ASSISTANT, response))
+    if not st.session_state.quiz_active:
+        st.session_state['refresh_chat'] = True
+
+def flashcard_panel_action(command):
+    response = handle_flashcard_interaction(command)
+    if not st.session_state['flashcard_active']:
+        st.session_state.messages.append(ChatMessage(Role.ASSISTANT, response))
+        st.session_state['refresh_chat'] = True
+
+def cancel_pomodoro():
+    st.session_state['pomodoro_active'] = False
+    st.session_state['pomodoro_start_time'] = None
+
+def leave_classroom_from_panel():
+    st.session_state.messages.append(ChatMessage(Role.ASSISTANT, leave_classroom()))
+    st.session_state['refresh_chat'] = True
+
+# The panels below are fragments: clicking one of their buttons reruns only that panel,
+# not the whole script. A panel asks for a full rerun only when the chat needs redrawing.
+
+@st.fragment
+def quiz_panel():
+    started = time.thread_time()
+    if st.session_state.pop('refresh_chat', False):
+        st.rerun()
+    
+    questions = st.session_state.get('quiz_questions')
+    if st.session_state['quiz_active'] and questions and st.session_state.current_question < len(questions):
+        index = st.session_state.current_question
+        question = questions[index]
+        
+        with st.container(border=True):
+            if st.session_state['quiz_feedback']:
+                st.caption(st.session_state['quiz_feedback'])
+            st.markdown(f"**Question {index + 1} of {len(questions)}:** {question.question}")
+            for letter, option in question.option_items():
+                st.button(f"{letter}: {option}", key=f"quiz_{index}_{letter}", on_click=answer_quiz_from_panel, args=(letter,), use_container_width=True)
+    
+    record_cpu_time("quiz panel", started)
+
+@st.fragment
+def flashcard_panel():
+    started = time.thread_time()
+    if st.session_state.pop('refresh_chat', False):
+        st.rerun()
     
-    st.markdown("<h1 class='main-header'>📚 EduBot - Your Smart Study Helper</h1>", unsafe_allow_html=True)
+    cards = st.session_state['flashcards']
+    index = st.session_state['flashcard_index']
+    if st.session_state['flashcard_active'] and index < len(cards):
+        card = cards[index]
+        flipped = st.session_state['current_card_flipped']
+        reviewing = st.session_state['flashcard_review']
+        
+        commands = ['flip']
+        if reviewing and flipped:
+            commands += list(REVIEW_GRADES)
+        commands += ['next', 'exit']
+        
+        with st.container(border=True):
+            st.caption(f"Card {index + 1} of {len(cards)} · {'Back' if flipped else 'Front'}")
+            st.markdown(f"### {card.back if flipped else card.front}")
+            for column, command in zip(st.columns(len(commands)), commands):
+                column.button(command.title(), key=f"flashcard_{command}", on_click=flashcard_panel_action, args=(command,), use_container_width=True)
+    
+    record_cpu_time("flashcard panel", started)
+
+@st.fragment(run_every=1)
+def pomodoro_timer():
+    started = time.thread_time()
+    if not (st.session_state['pomodoro_active'] and st.session_state['pomodoro_start_time']):
+        # Cancelled: one full rerun removes the timer and stops the one-second refresh
+        st.rerun()
+    
+    notification = check_pomodoro_timer()
+    if notification:
+        st.session_state.messages.append(ChatMessage(Role.ASSISTANT, notification))
+        st.rerun()
+    
+    elapsed_seconds = (datetime.datetime.now() - st.session_state['pomodoro_start_time']).total_seconds()
+    remaining_seconds = max(0, st.session_state['pomodoro_duration'] * 60 - elapsed_seconds)
+    minutes = int(remaining_seconds // 60)
+    seconds = int(remaining_seconds % 60)
+    
+    st.subheader("⏱️ Pomodoro Timer")
+    st.markdown(f"**Time Remaining:** {minutes:02d}:{seconds:02d}")
+    
+    progress = 1 - (remaining_seconds / (st.session_state['pomodoro_duration'] * 60))
+    st.progress(min(1.0, max(0.0, progress)))
+    
+    st.button("Cancel Timer", on_click=cancel_pomodoro)
+    record_cpu_time("pomodoro timer", started)
+
+@st.fragment(run_every=2)
+def classroom_panel():
+    # Polls the shared classroom, so every student sees the leaderboard move without sending a message
+    started = time.thread_time()
+    if st.session_state.pop('refresh_chat', False) or not st.session_state['classroom']:
+        st.rerun()
+    
+    membership = st.session_state['classroom']
+    classroom = get_classrooms().get(membership['code'])
+    with st.container(border=True):
+        if classroom is None:
+            st.info(f"Classroom {membership['code']} has ended.")
+        else:
+            standings, joined, finished = classroom.standings()
+            total = len(classroom.questions)
+            st.markdown(f"**🏫 Classroom {classroom.code}** · {classroom.topic} · {joined} joined, {finished} finished")
+            if standings:
+                rows = "\n".join(
+                    f"| {rank} | {name.replace('|', '/')} | {score}/{total} | {answered}/{total} |"
+                    for rank, (name, score, answered) in enumerate(standings, start=1)
+                )
+                st.markdown(f"| # | Student | Score | Answered |\n|---|---|---|---|\n{rows}")
+            else:
+                st.caption(f"Waiting for students to join with code {classroom.code}...")
+            
+            if membership['role'] == 'student':
+                st.caption(f"You are #{classroom.rank(membership['name'])} of {joined}.")
+                st.button("Leave Classroom", on_click=leave_classroom_from_panel)
+            else:
+                st.button("End Classroom", on_click=leave_classroom_from_panel)
+    
+    record_cpu_time("classroom panel", started)
+
+@st.fragment
+def study_history_panel():
+    started = time.thread_time()
+    st.subheader("📊 Study History")
+    
+    if st.session_state['study_history']:
+        if st.button("View Study History"):
+            history_text = "Your recent study sessions:\n\n"
+            for i, session in enumerate(st.session_state['study_history'][-5:]):
+                timestamp = datetime.datetime.fromtimestamp(session.timestamp).strftime("%Y-%m-%d %H:%M:%S")
+                history_text += f"{i+1}. {session.type.value.replace('_', ' ').title()} on '{session.topic}' ({timestamp})"
+                if session.total:
+                    history_text += f" - Score: {session.correct}/{session.total}"
+                if session.duration:
+                    history_text += f" - Duration: {session.duration} minutes"
+                history_text += "\n"
+            st.info(history_text)
+    else:
+        st.info("No study history yet. Start learning to track your progress!")
+    
+    if st.button("Clear Study History"):
+        clear_study_history()
+        st.success("Study history cleared!")
+    
+    record_cpu_time("history panel", started)
+
+@st.fragment
+def progress_panel():
+    import numpy as np
+    import pandas as pd
+    started = time.thread_time()
+    analytics = get_history_analytics()
+    st.subheader("📈 Your Progress")
+    
+    if analytics.size:
+        current_streak, longest_streak = analytics.streaks()
+        codes, accuracy, totals = analytics.topic_accuracy()
+        answered = int(totals.sum())
+        columns = st.columns(4)
+        columns[0].metric("Current streak (days)", current_streak)
+        columns[1].metric("Longest streak (days)", longest_streak)
+        columns[2].metric("Focus time", f"{analytics.focus_minutes // 60}h {analytics.focus_minutes % 60}m")
+        columns[3].metric("Quiz accuracy", f"{analytics.topic_correct.sum() / answered:.0%}" if answered else "-")
+        
+        if answered:
+            order = np.argsort(-totals, kind='stable')[:15]
+            st.markdown("**Accuracy by topic**")
+            st.bar_chart(pd.DataFrame({"Accuracy (%)": accuracy[order] * 100}, index=[analytics.topics[code] for code in codes[order]]))
+            
+            weeks, trend = analytics.accuracy_trend()
+            st.markdown("**Weekly quiz accuracy**")
+            st.line_chart(pd.DataFrame(trend, index=weeks))
+            
+            weak_topics = analytics.weak_topics()
+            if weak_topics:
+                st.markdown("**Topics to revisit**")
+                st.markdown("\n".join(f"- {topic}: {topic_accuracy:.0%} over {total} questions" for topic, topic_accuracy, total in weak_topics))
+        
+        dates, minutes = analytics.minutes_per_day()
+        if minutes.any():
+            st.markdown("**Focus minutes, last 30 days**")
+            st.bar_chart(pd.DataFrame({"Minutes": minutes}, index=dates))
+    else:
+        st.info("No study history yet. Finish a quiz or a Pomodoro session to see your progress here.")
+    
+    record_cpu_time("progress panel", started)
+
+def main():
+    st.set_page_config(
+        page_title="EduBot - Your Smart Study Helper",
+        page_icon="📚",
+        layout="wide"
+    )
+    
+    st.markdown(build_theme_css(st.session_state['theme']), unsafe_allow_html=True)
+    st.markdown(HEADER_HTML, unsafe_allow_html=True)
     st.markdown("Chat with your AI study buddy! Ask questions, generate quizzes, summarize text, create flashcards, and more.")
     
+    expire_prefetch()
+    
     # Check if a Pomodoro timer has completed
     pomodoro_notification = check_pomodoro_timer()
     if pomodoro_notification:
         st.info(pomodoro_notification)
-        st.session_state.messages.append({"role": "assistant", "content": pomodoro_notification})
+        st.session_state.messages.append(ChatMessage(Role.ASSISTANT, pomodoro_notification))
     
     # Sidebar
     with st.sidebar:
@@ -824,32 +3067,63 @@ def main():
             help="Enter your Google Gemini API key. You can get one from https://makersuite.google.com/app/apikey"
         )
         
-        if api_key:
+        # A key typed here is used by this session only; otherwise requests share the server's key pool
+        if api_key and api_key != DEFAULT_API_KEY:
             if api_key != os.getenv("GOOGLE_API_KEY"):
-                genai.configure(api_key=api_key)
                 st.success("API key updated!")
                 st.session_state['current_api_key'] = api_key
+            else:
+                st.session_state['current_api_key'] = None
         else:
-            st.warning("Please enter your Google Gemini API key to use EduBot.")
+            st.session_state['current_api_key'] = None
+            if not get_key_pool().keys:
+                st.warning("Please enter your Google Gemini API key to use EduBot.")
         
         # Theme toggle
         theme = st.selectbox("Theme", ["Light", "Dark"], index=0 if st.session_state['theme'] == 'light' else 1)
         if (theme == "Light" and st.session_state['theme'] == 'dark') or (theme == "Dark" and st.session_state['theme'] == 'light'):
             st.session_state['theme'] = theme.lower()
-            st.experimental_rerun()
+            st.rerun()
         
         # Add a debug mode toggle
         debug_mode = st.checkbox("Debug Mode", value=st.session_state['debug_mode'])
         if debug_mode != st.session_state['debug_mode']:
             st.session_state['debug_mode'] = debug_mode
-            st.experimental_rerun()
+            st.rerun()
         
         # Display available models when in debug mode
         if st.session_state['debug_mode']:
             st.subheader("Debug Information")
+            metrics = st.session_state['perf_metrics']
+            st.caption(f"Module imports: {IMPORT_SECONDS * 1000:.1f} ms")
+            if metrics:
+                st.caption(f"Last rerun: {metrics[-1] * 1000:.1f} ms (average of last {len(metrics)}: {sum(metrics) / len(metrics) * 1000:.1f} ms)")
+            for scope, samples in st.session_state['cpu_metrics'].items():
+                st.caption(f"CPU per {scope}: {sum(samples) / len(samples) * 1000:.2f} ms (last {len(samples)})")
+            state_bytes = sum(deep_sizeof(st.session_state[key]) for key in ('messages', 'study_history', 'flashcards', 'quiz_questions') if key in st.session_state)
+            st.caption(f"Session records: {state_bytes / 1024:.1f} KiB ({len(st.session_state['messages'])} messages, {len(st.session_state['study_history'])} history entries)")
+            st.caption(
+                f"Prompt budget {PROMPT_TOKEN_BUDGET} tokens · templates: "
+                + ", ".join(f"{template.key} (~{template.tokens})" for template in PROMPTS.values())
+            )
+            stats = st.session_state['prefetch_stats']
+            st.caption(
+                f"Prefetch: {stats['hits']} used, {stats['misses']} failed, {stats['discarded']} discarded · "
+                f"~{stats['seconds_saved']:.1f} s saved for {stats['tokens_used']} tokens ({stats['tokens_wasted']} wasted)"
+            )
+            if st.session_state.get('current_api_key'):
+                st.caption("API key: this session's own key")
+            pool = get_key_pool()
+            for key in pool.keys:
+                key_stats = pool.stats[key]
+                status = "cooling down" if key_stats['cooldown_until'] > time.time() else "healthy"
+                st.caption(
+                    f"Pool key {mask_api_key(key)}: {status}, {key_stats['in_flight']} in flight, "
+                    f"{key_stats['requests']} requests, {key_stats['failures']} failures, {key_stats['tokens']} tokens"
+                )
             if st.button("Check Available Models"):
                 try:
-                    available_models = [model.name for model in genai.list_models()]
+                    available_models = list_model_names(st.session_state.get('current_api_key'))
                     st.session_state['available_models'] = available_models
                     st.write("Available models:")
                     for model in available_models:
@@ -857,27 +3131,74 @@ def main():
                 except Exception as e:
                     st.error(f"Error listing models: {str(e)}")
         
+        # Study materials section
+        st.markdown("---")
+        st.subheader("📄 Study Materials")
+        
+        uploaded_file = st.file_uploader(
+            "Upload lecture notes or a PDF",
+            type=["pdf", "txt", "md"],
+            help="EduBot can summarize the whole document and build quizzes and flashcards from it."
+        )
+        
+        if uploaded_file is not None and uploaded_file.file_id != st.session_state.get('active_document_file_id'):
+            try:
+                with st.spinner(f"Reading {uploaded_file.name}..."):
+                    document = ingest_document(uploaded_file, uploaded_file.name)
+                    index_document(document['hash'])
+                if document['chunks']:
+                    st.session_state['active_document'] = {"hash": document['hash'], "name": document['name']}
+                else:
+                    st.warning(f"I couldn't find any text in {uploaded_file.name}.")
+                st.session_state['active_document_file_id'] = uploaded_file.file_id
+            except Exception as e:
+                st.error(f"Error reading document: {str(e)}")
+        elif uploaded_file is None and st.session_state.get('active_document_file_id'):
+            st.session_state['active_document'] = None
+            st.session_state['active_document_file_id'] = None
+        
+        if st.session_state.get('active_document'):
+            st.success(f"Using {st.session_state['active_document']['name']}. Try 'summarize the document' or 'quiz me on my notes'.")
+        
+        # Pomodoro timer, refreshed every second on its own
+        if st.session_state['pomodoro_active']:
+            pomodoro_timer()
+        
         # Study history section
         st.markdown("---")
-        st.subheader("📊 Study History")
-        
-        if st.session_state['study_history']:
-            if st.button("View Study History"):
-                history_text = "Your recent study sessions:\n\n"
-                for i, session in enumerate(st.session_state['study_history'][-5:]):
-                    history_text += f"{i+1}. {session['type'].title()} on '{session['topic']}' ({session['timestamp']})"
-                    if session.get('score'):
-                        history_text += f" - Score: {session['score']}"
-                    if session.get('duration'):
-                        history_text += f" - Duration: {session['duration']}"
-                    history_text += "\n"
-                st.info(history_text)
-        else:
-            st.info("No study history yet. Start learning to track your progress!")
+        study_history_panel()
+        st.toggle("Show progress dashboard", key='show_progress')
+        
+        # Import and export section
+        st.markdown("---")
+        st.subheader("📦 Import & Export")
+        dataset = st.selectbox("Export data", list(EXPORTS))
+        export_format = st.selectbox("Export format", list(EXPORTS[dataset][1]))
+        if st.button("Prepare Export"):
+            try:
+                with st.spinner(f"Exporting {dataset.lower()}..."):
+                    file_name, data = export_data(dataset, export_format)
+                st.download_button(f"Download {file_name}", data, file_name=file_name)
+            except Exception as e:
+                st.error(f"Error exporting data: {str(e)}")
         
-        if st.button("Clear Study History"):
-            st.session_state['study_history'] = []
-            st.success("Study history cleared!")
+        deck_file = st.file_uploader(
+            "Import flashcards",
+            type=["txt", "tsv", "csv", "jsonl"],
+            help="Anki text exports, CSV with front and back columns, or JSONL. Cards without a deck go into a deck named after the file."
+        )
+        if deck_file is not None and deck_file.file_id != st.session_state.get('imported_deck_file_id'):
+            try:
+                with st.spinner(f"Importing {deck_file.name}..."):
+                    read, added, decks = import_flashcard_deck(st.session_state['user_id'], deck_file, deck_file.name, os.path.splitext(deck_file.name)[0])
+                st.session_state['imported_deck_file_id'] = deck_file.file_id
+                st.success(f"Added {added} of {read} flashcards to {decks} deck{'s' if decks != 1 else ''}. Type 'review flashcards' to study them.")
+            except Exception as e:
+                st.error(f"Error importing flashcards: {str(e)}")
+        
+        due_count = count_due_cards(st.session_state['user_id'])
+        if due_count:
+            st.info(f"🗂️ You have {due_count} flashcards due for review. Type 'review flashcards' to start.")
         
         st.markdown("---")
         st.markdown("### About EduBot")
@@ -887,10 +3208,12 @@ def main():
         **Features:**
         - Chat about any educational topic
         - Generate quizzes on any subject
+        - Run live classroom quizzes with a shared leaderboard
         - Create and study flashcards
+        - Review saved flashcards with spaced repetition
         - Create personalized study plans
         - Set Pomodoro timers for focused study
-        - Summarize lengthy texts
+        - Summarize lengthy texts and uploaded documents
         - Solve math problems step-by-step
         
         Powered by Google Gemini API
@@ -902,6 +3225,7 @@ def main():
         suggested_prompts = [
             "Create a quiz about photosynthesis",
             "Make flashcards on world capitals",
+            "Review my due flashcards",
             "Create a study plan for calculus",
             "Start a 25-minute Pomodoro timer",
             "Summarize the key events of World War II",
@@ -910,44 +3234,25 @@ def main():
         ]
         
         for prompt in suggested_prompts:
-            if st.button(prompt):
-                st.session_state.messages.append({"role": "user", "content": prompt})
-                st.experimental_rerun()
+            st.button(prompt, on_click=queue_prompt, args=(prompt,))
 
+    if st.session_state.get('show_progress'):
+        progress_panel()
+    
     # Display chat messages
     chat_container = st.container()
     with chat_container:
         for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
+            with st.chat_message(message.role.value):
+                st.markdown(message.content)
     
-    # Display Pomodoro timer if active
-    if st.session_state['pomodoro_active'] and st.session_state['pomodoro_start_time']:
-        current_time = datetime.datetime.now()
-        elapsed_time = current_time - st.session_state['pomodoro_start_time']
-        elapsed_seconds = elapsed_time.total_seconds()
-        remaining_seconds = max(0, st.session_state['pomodoro_duration'] * 60 - elapsed_seconds)
-        
-        minutes = int(remaining_seconds // 60)
-        seconds = int(remaining_seconds % 60)
-        
-        st.sidebar.subheader("⏱️ Pomodoro Timer")
-        st.sidebar.markdown(f"**Time Remaining:** {minutes:02d}:{seconds:02d}")
-        
-        progress = 1 - (remaining_seconds / (st.session_state['pomodoro_duration'] * 60))
-        st.sidebar.progress(min(1.0, max(0.0, progress)))
-        
-        if st.sidebar.button("Cancel Timer"):
-            st.session_state['pomodoro_active'] = False
-            st.session_state['pomodoro_start_time'] = None
-            st.experimental_rerun()
-
     # Get user input
-    user_input = st.chat_input("Ask me anything about your studies...")
+    user_input = st.chat_input("Ask me anything about your studies...") or st.session_state.pop('queued_prompt', None)
+    pomodoro_was_active = st.session_state['pomodoro_active']
 
     if user_input:
         # Add user message to chat history
-        st.session_state.messages.append({"role": "user", "content": user_input})
+        st.session_state.messages.append(ChatMessage(Role.USER, user_input))
         
         # Display user message
         with st.chat_message("user"):
@@ -963,8 +3268,8 @@ def main():
                     if flashcard_response:
                         response = flashcard_response
                     else:
-                        # Check if we're in the middle of a quiz
-                        quiz_response = handle_quiz_answer(user_input)
+                        # Check if we're in the middle of a quiz; a classroom can be left at any point in its quiz
+                        quiz_response = handle_classroom_leave(user_input) or handle_quiz_answer(user_input)
                         
                         if quiz_response:
                             response = quiz_response
@@ -993,7 +3298,19 @@ def main():
                     response = error_msg
         
         # Add assistant response to chat history
-        st.session_state.messages.append({"role": "assistant", "content": response})
+        st.session_state.messages.append(ChatMessage(Role.ASSISTANT, response))
+    
+    # Interactive panels for a classroom, an active quiz or a flashcard deck
+    if st.session_state['classroom']:
+        classroom_panel()
+    quiz_panel()
+    flashcard_panel()
+    
+    record_rerun_time()
+    
+    # The sidebar was drawn before this message started a timer, so draw it again
+    if st.session_state['pomodoro_active'] and not pomodoro_was_active:
+        st.rerun()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
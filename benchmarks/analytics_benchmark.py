@@ -0,0 +1,97 @@
+"""Progress analytics benchmark for the EduBot Streamlit app.
+
+Generates a synthetic study history, then times building the columnar
+history, appending sessions one at a time and computing everything the
+progress dashboard shows:
+
+    python benchmarks/analytics_benchmark.py --rows 100000 --topics 200
+
+Before timing, it checks that a history built by one run of app.py keeps
+counting sessions recorded by a later run, as happens when Streamlit reruns
+the script. Requires the app's own dependencies, since the analytics are
+imported from app.py.
+"""
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from app import HistoryAnalytics, SessionType, StudySession  # noqa: E402
+
+
+def build_history(rows, topics, days):
+    rng = random.Random(0)
+    now = int(time.time())
+    sessions = []
+    for _ in range(rows):
+        timestamp = now - rng.randrange(days * 86400)
+        kind = rng.random()
+        if kind < 0.5:
+            sessions.append(StudySession(timestamp, SessionType.QUIZ, f"topic {rng.randrange(topics)}", None, rng.randrange(6), 5))
+        elif kind < 0.7:
+            sessions.append(StudySession(timestamp, SessionType.POMODORO, "Focus Session", 25))
+        else:
+            sessions.append(StudySession(timestamp, SessionType.FLASHCARDS, f"topic {rng.randrange(topics)}"))
+    sessions.sort(key=lambda session: session.timestamp)
+    return sessions
+
+
+def check_across_reruns(sessions):
+    # Streamlit executes app.py as a new module on every rerun, so records from a later run
+    # carry their own copies of the enums and classes
+    spec = importlib.util.spec_from_file_location("app_rerun", os.path.join(REPO_ROOT, "app.py"))
+    rerun = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(rerun)
+
+    analytics = HistoryAnalytics.from_sessions(sessions)
+    for session in sessions:
+        analytics.append(rerun.StudySession(session.timestamp, rerun.SessionType(session.type.value), session.topic,
+                                            session.duration, session.correct, session.total))
+    expected = HistoryAnalytics.from_sessions(sessions + sessions)
+    assert analytics.focus_minutes == expected.focus_minutes, (analytics.focus_minutes, expected.focus_minutes)
+    assert (analytics.topic_total == expected.topic_total).all()
+    assert analytics.streaks() == expected.streaks()
+
+
+def timed(function, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--days", type=int, default=365)
+    args = parser.parse_args()
+
+    sessions = build_history(args.rows, args.topics, args.days)
+    analytics = HistoryAnalytics.from_sessions(sessions)
+    check_across_reruns(sessions[:1000])
+
+    def append_all():
+        incremental = HistoryAnalytics()
+        for session in sessions:
+            incremental.append(session)
+
+    print(f"{args.rows} sessions, {args.topics} topics over {args.days} days (rerun check passed)")
+    print(f"{'build columns':<24}{timed(lambda: HistoryAnalytics.from_sessions(sessions), 3):>10.1f} ms")
+    print(f"{'append (per session)':<24}{timed(append_all, 1) / args.rows * 1000:>10.2f} us")
+    print(f"{'topic accuracy':<24}{timed(analytics.topic_accuracy):>10.2f} ms")
+    print(f"{'weak topics':<24}{timed(analytics.weak_topics):>10.2f} ms")
+    print(f"{'streaks':<24}{timed(analytics.streaks):>10.2f} ms")
+    print(f"{'minutes per day':<24}{timed(analytics.minutes_per_day):>10.2f} ms")
+    print(f"{'accuracy trend':<24}{timed(analytics.accuracy_trend):>10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
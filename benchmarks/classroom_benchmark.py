@@ -0,0 +1,82 @@
+"""Classroom leaderboard benchmark for the EduBot Streamlit app.
+
+Opens one classroom, lets many simulated students join and answer every
+question from their own threads while a reader polls the leaderboard the way
+the classroom panel does, then reports answer and poll latencies:
+
+    python benchmarks/classroom_benchmark.py --students 500 --questions 5
+
+Requires the app's own dependencies, since the classroom is imported from app.py.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import ClassroomRegistry, QuizQuestion  # noqa: E402
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=500)
+    parser.add_argument("--questions", type=int, default=5)
+    args = parser.parse_args()
+
+    questions = [QuizQuestion(f"Question {i}?", ("A1", "B1", "C1", "D1"), "B") for i in range(args.questions)]
+    classroom = ClassroomRegistry().open("benchmark", questions)
+    start_line = threading.Barrier(args.students + 1)
+    answer_times = []
+    poll_times = []
+    done = threading.Event()
+
+    def student(number):
+        rng = random.Random(number)
+        name = f"Student {number}"
+        classroom.join(name)
+        start_line.wait()
+        timings = []
+        for _ in questions:
+            time.sleep(rng.uniform(0, 0.01))
+            started = time.perf_counter()
+            classroom.record_answer(name, rng.random() < 0.6)
+            timings.append(time.perf_counter() - started)
+        answer_times.extend(timings)
+
+    def poll():
+        while not done.is_set():
+            started = time.perf_counter()
+            classroom.standings()
+            poll_times.append(time.perf_counter() - started)
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target=student, args=(number,)) for number in range(args.students)]
+    reader = threading.Thread(target=poll)
+    for thread in threads:
+        thread.start()
+    reader.start()
+    start_line.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    reader.join()
+
+    standings, joined, finished = classroom.standings()
+    print(f"{joined} students, {len(answer_times)} answers in {elapsed:.2f} s ({finished} finished)")
+    print(f"record_answer  p50 {percentile(answer_times, 0.5):.3f} ms  p99 {percentile(answer_times, 0.99):.3f} ms")
+    print(f"standings poll p50 {percentile(poll_times, 0.5):.3f} ms  p99 {percentile(poll_times, 0.99):.3f} ms ({len(poll_times)} polls)")
+    print("top 3:", ", ".join(f"{name} ({score})" for name, score, _ in standings[:3]))
+
+
+if __name__ == "__main__":
+    main()
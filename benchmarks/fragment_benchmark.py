@@ -0,0 +1,77 @@
+"""Fragment versus full-rerun benchmark for the EduBot Streamlit app.
+
+Starts a quiz in an AppTest session, answers it by clicking the quiz panel's
+buttons and compares what one click costs inside the panel's fragment with a
+full rerun of the script:
+
+    python benchmarks/fragment_benchmark.py --clicks 20
+
+AppTest reruns the whole script on every interaction, so the click cost is the
+CPU time the app itself records for the quiz panel fragment, which is all a
+click reruns in the live app. Requires streamlit (for streamlit.testing) and
+the app's own dependencies.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+
+def mean_ms(samples):
+    return sum(samples) / len(samples) * 1000 if samples else 0.0
+
+
+def measure(clicks, reruns):
+    from streamlit.testing.v1 import AppTest
+
+    from app import QuizQuestion
+
+    app = AppTest.from_file(os.path.join(REPO_ROOT, "app.py"), default_timeout=60)
+    app.run()
+    app.session_state["quiz_questions"] = [
+        QuizQuestion(f"Question {i}: which organelle produces ATP?", ("Nucleus", "Mitochondria", "Ribosome", "Golgi body"), "B")
+        for i in range(clicks + 1)
+    ]
+    app.session_state["answered"] = [False] * (clicks + 1)
+    app.session_state["current_question"] = 0
+    app.session_state["score"] = 0
+    app.session_state["quiz_active"] = True
+
+    rerun_times = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        app.run()
+        rerun_times.append(time.perf_counter() - start)
+    full_rerun_cpu = list(app.session_state["cpu_metrics"]["full rerun"])
+
+    app.session_state["cpu_metrics"] = {}
+    for index in range(clicks):
+        app.button(key=f"quiz_{index}_B").click().run()
+    assert app.session_state["score"] == clicks, app.session_state["score"]
+    panel_cpu = app.session_state["cpu_metrics"]["quiz panel"]
+
+    return mean_ms(rerun_times), mean_ms(full_rerun_cpu), mean_ms(panel_cpu)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clicks", type=int, default=20)
+    parser.add_argument("--reruns", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ["EDUBOT_DATA_DIR"] = data_dir
+        rerun_ms, rerun_cpu_ms, click_cpu_ms = measure(args.clicks, args.reruns)
+
+    print(f"{args.clicks} quiz answers clicked, {args.reruns} full reruns")
+    print(f"{'full rerun':<24}{rerun_cpu_ms:>10.2f} ms CPU{rerun_ms:>10.1f} ms wall (AppTest)")
+    print(f"{'quiz panel click':<24}{click_cpu_ms:>10.2f} ms CPU")
+    print(f"a click reruns {click_cpu_ms / rerun_cpu_ms:.1%} of the script's CPU time")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Session-state memory benchmark for the EduBot Streamlit app.
+
+Builds the records a long study session leaves in st.session_state (chat
+messages, quiz questions, flashcards and study history) once as the plain
+dicts the app used to keep and once as the app's slotted records, then reports
+the bytes held per session and the size of the history written to disk:
+
+    python benchmarks/memory_benchmark.py --messages 2000 --history 5000
+
+Requires the app's own dependencies, since the records are imported from app.py.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import (  # noqa: E402
+    ChatMessage, Flashcard, QuizQuestion, Role, SessionType, StudySession, deep_sizeof, dump_jsonl
+)
+
+
+def build_dicts(messages, history, questions, cards):
+    return {
+        "messages": [
+            {"role": "user" if i % 2 else "assistant", "content": f"Message {i} about photosynthesis and cell respiration"}
+            for i in range(messages)
+        ],
+        "quiz_questions": [
+            {
+                "question": f"Question {i}: which organelle produces ATP?",
+                "options": {"A": "Nucleus", "B": "Mitochondria", "C": "Ribosome", "D": "Golgi body"},
+                "answer": "B",
+                "explanation": "Mitochondria carry out cellular respiration."
+            }
+            for i in range(questions)
+        ],
+        "flashcards": [
+            {"front": f"Term {i}", "back": f"Definition of term {i}", "id": i, "ease": 2.5, "interval": 0, "repetitions": 0}
+            for i in range(cards)
+        ],
+        "study_history": [
+            {
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "type": "quiz",
+                "topic": f"topic {i % 50}",
+                "duration": None,
+                "score": f"{i % 6}/5"
+            }
+            for i in range(history)
+        ],
+    }
+
+
+def build_records(messages, history, questions, cards):
+    now = int(time.time())
+    return {
+        "messages": [
+            ChatMessage(Role.USER if i % 2 else Role.ASSISTANT, f"Message {i} about photosynthesis and cell respiration")
+            for i in range(messages)
+        ],
+        "quiz_questions": [
+            QuizQuestion(
+                f"Question {i}: which organelle produces ATP?",
+                ("Nucleus", "Mitochondria", "Ribosome", "Golgi body"),
+                "B",
+                "Mitochondria carry out cellular respiration."
+            )
+            for i in range(questions)
+        ],
+        "flashcards": [Flashcard(f"Term {i}", f"Definition of term {i}", i) for i in range(cards)],
+        "study_history": [
+            StudySession(now, SessionType.QUIZ, f"topic {i % 50}", None, i % 6, 5)
+            for i in range(history)
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--history", type=int, default=5000)
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--cards", type=int, default=200)
+    args = parser.parse_args()
+
+    sizes = (args.messages, args.history, args.questions, args.cards)
+    dicts = build_dicts(*sizes)
+    records = build_records(*sizes)
+
+    print(f"{'state':<16}{'dicts':>12}{'records':>12}{'saved':>8}")
+    for key in dicts:
+        before, after = deep_sizeof(dicts[key]), deep_sizeof(records[key])
+        print(f"{key:<16}{before / 1024:>9.1f} KiB{after / 1024:>9.1f} KiB{1 - after / before:>7.0%}")
+    before, after = deep_sizeof(dicts), deep_sizeof(records)
+    print(f"{'total':<16}{before / 1024:>9.1f} KiB{after / 1024:>9.1f} KiB{1 - after / before:>7.0%}")
+
+    dict_lines = sum(len(json.dumps(entry)) + 1 for entry in dicts["study_history"])
+    record_lines = sum(len(line) for line in dump_jsonl(records["study_history"]))
+    print(f"history on disk: {dict_lines / 1024:.1f} KiB as JSON objects, {record_lines / 1024:.1f} KiB as JSONL rows")
+
+
+if __name__ == "__main__":
+    main()
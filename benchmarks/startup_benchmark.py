@@ -0,0 +1,87 @@
+"""Cold-start and rerun benchmark for the EduBot Streamlit app.
+
+Each variant runs in a fresh interpreter so that the first run pays the full
+import cost. A variant is either the working-tree app.py or app.py at a git
+revision, which makes before/after comparisons a single command:
+
+    python benchmarks/startup_benchmark.py --baseline HEAD~1 --reruns 20
+
+Requires streamlit (for streamlit.testing) and the app's own dependencies.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(script_path, reruns):
+    from streamlit.testing.v1 import AppTest
+
+    start = time.perf_counter()
+    app = AppTest.from_file(script_path, default_timeout=60)
+    app.run()
+    cold_start = time.perf_counter() - start
+
+    rerun_times = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        app.run()
+        rerun_times.append(time.perf_counter() - start)
+
+    sdk_loaded = 'google.genai' in sys.modules or 'google.generativeai' in sys.modules
+    return {
+        "cold_start_ms": cold_start * 1000,
+        "rerun_mean_ms": sum(rerun_times) / len(rerun_times) * 1000 if rerun_times else 0.0,
+        "rerun_min_ms": min(rerun_times) * 1000 if rerun_times else 0.0,
+        "sdk_imported_at_startup": sdk_loaded,
+    }
+
+
+def run_variant(script_path, reruns, data_dir):
+    env = dict(os.environ, EDUBOT_DATA_DIR=data_dir)
+    output = subprocess.run(
+        [sys.executable, __file__, "--measure", script_path, "--reruns", str(reruns)],
+        check=True, capture_output=True, text=True, env=env, cwd=os.path.dirname(script_path)
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", help="git revision of app.py to compare against")
+    parser.add_argument("--reruns", type=int, default=10)
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure, args.reruns)))
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        variants = [("current", os.path.join(REPO_ROOT, "app.py"))]
+        if args.baseline:
+            baseline_path = os.path.join(workdir, "app.py")
+            source = subprocess.run(
+                ["git", "show", f"{args.baseline}:app.py"],
+                check=True, capture_output=True, text=True, cwd=REPO_ROOT
+            ).stdout
+            with open(baseline_path, "w", encoding="utf-8") as f:
+                f.write(source)
+            variants.insert(0, (f"baseline ({args.baseline})", baseline_path))
+
+        print(f"{'variant':<24}{'cold start':>14}{'rerun mean':>14}{'rerun min':>14}  SDK at startup")
+        for name, path in variants:
+            result = run_variant(path, args.reruns, os.path.join(workdir, name.split()[0]))
+            print(
+                f"{name:<24}{result['cold_start_ms']:>11.1f} ms{result['rerun_mean_ms']:>11.1f} ms"
+                f"{result['rerun_min_ms']:>11.1f} ms  {'yes' if result['sdk_imported_at_startup'] else 'no'}"
+            )
+
+
+if __name__ == "__main__":
+    main()